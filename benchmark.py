@@ -0,0 +1,223 @@
+"""Route level benchmarks against a synthetic SQLite database.
+
+Seeds a database at the requested scale, drives the main routes through the
+Flask test client and reports latency percentiles, throughput, queries per
+request and peak memory growth for each route.
+
+    python benchmark.py --complimentees 10000 --compliments 1000000
+    python benchmark.py --reuse --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import resource
+
+sys.dont_write_bytecode = True
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from flatterer import app, db
+from flatterer.bulk import chunked
+from flatterer.models import (User, Gender, Complimentee, Theme, Compliment,
+                              text_hash)
+
+WORDS = ("smile laugh kindness wit charm style courage heart energy voice "
+         "ideas taste patience warmth spark brilliance grace humor").split()
+GENDERS = ("Male", "Female", "Any")
+BATCH_SIZE = 10000
+
+queries = [0]
+submissions = itertools.count()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    queries[0] += 1
+
+
+def random_compliment():
+    return "your %s and %s are %s" % (random.choice(WORDS),
+                                      random.choice(WORDS),
+                                      random.choice(["wonderful", "amazing",
+                                                     "inspiring", "lovely"]))
+
+
+def seed(args):
+    """Creates and fills the benchmark database."""
+    db.create_all()
+    for gender in GENDERS:
+        db.session.add(Gender(gender))
+    admin = User('bench', 'Bench', 'bench', admin=True)
+    db.session.add(admin)
+    db.session.commit()
+
+    complimentees = ({'name': 'person%d' % i, 'url': 'person%d' % i,
+                      'greeting': 'you are awesome!', 'owner': admin.id}
+                     for i in xrange(args.complimentees))
+    for batch in chunked(complimentees, BATCH_SIZE):
+        db.session.execute(Complimentee.__table__.insert(), batch)
+    themes = ({'user_id': i + 1, 'theme_path': 'http://example.com/%d.jpg' % i,
+               'song_path': 'http://www.youtube.com/watch?v=%d' % i}
+              for i in xrange(0, args.complimentees, 2))
+    for batch in chunked(themes, BATCH_SIZE):
+        db.session.execute(Theme.__table__.insert(), batch)
+
+    # A fifth of the compliments are personal, the rest spread over the
+    # genders with one in ten waiting for approval. Numbered, since
+    # compliment texts are unique.
+    def compliments():
+        for i in xrange(args.compliments):
+            compliment = '%s %d' % (random_compliment(), i)
+            if i % 5 == 0:
+                yield {'compliment': compliment, 'gender': None,
+                       'user_id': random.randint(1, args.complimentees),
+                       'approved': True, 'text_hash': text_hash(compliment)}
+            else:
+                yield {'compliment': compliment,
+                       'gender': GENDERS[i % 3], 'user_id': None,
+                       'approved': i % 10 != 1,
+                       'text_hash': text_hash(compliment)}
+    for batch in chunked(compliments(), BATCH_SIZE):
+        db.session.execute(Compliment.__table__.insert(), batch)
+    db.session.commit()
+
+
+def routes(args):
+    """Returns (name, login, method, url factory, data factory) tuples."""
+    def user_url():
+        return 'person%d' % random.randrange(args.complimentees)
+
+    def unapproved_ids():
+        return {'approve': [str(random.randrange(2, args.compliments, 10))
+                            for i in range(20)]}
+    return [
+        ('compliment_gender_name', False, 'GET',
+         lambda: '/compliment/%s/Sam' % random.choice(GENDERS[:2]), None),
+        ('gender_feed', False, 'GET',
+         lambda: '/feed/gender/%s' % random.choice(GENDERS[:2]), None),
+        ('compliment_individual', False, 'GET',
+         lambda: '/compliment/' + user_url(), None),
+        ('individual_feed', False, 'GET',
+         lambda: '/feed/user/' + user_url(), None),
+        ('control_panel', True, 'GET', lambda: '/control_panel', None),
+        ('list_complimentees', True, 'GET',
+         lambda: '/list_complimentees', None),
+        ('search', True, 'GET',
+         lambda: '/control_panel/search?q=' + random.choice(WORDS), None),
+        # Numbered so submissions aren't rejected as duplicates.
+        ('add_compliment', False, 'POST', lambda: '/add_compliment',
+         lambda: {'compliment': '%s %d' % (random_compliment(),
+                                           next(submissions)),
+                  'gender': 'Any'}),
+        ('approve_compliments', True, 'POST', lambda: '/control_panel',
+         unapproved_ids),
+    ]
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_route(client, method, make_url, make_data, requests):
+    """Times `requests` calls to a route and returns its statistics."""
+    timings = []
+    queries[0] = 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for i in xrange(requests):
+        url = make_url()
+        data = make_data() if make_data else None
+        began = time.time()
+        # Buffered, so streamed pages are timed to their last byte.
+        response = client.open(url, method=method, data=data, buffered=True)
+        timings.append(time.time() - began)
+        if response.status_code >= 400:
+            raise RuntimeError("%s %s returned %d" % (method, url,
+                                                     response.status_code))
+    elapsed = time.time() - start
+    timings.sort()
+    return {'requests': requests,
+            'p50_ms': percentile(timings, 0.50) * 1000,
+            'p95_ms': percentile(timings, 0.95) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000,
+            'throughput_rps': requests / elapsed,
+            'queries_per_request': queries[0] / float(requests),
+            # ru_maxrss is the peak for the whole process, in kilobytes.
+            'peak_rss_growth_kb': (resource.getrusage(resource.RUSAGE_SELF)
+                                   .ru_maxrss - rss)}
+
+
+def compare(results, baseline):
+    """Prints the change in p50 latency and throughput against a baseline."""
+    print "\nChange against baseline:"
+    for name, stats in sorted(results['routes'].items()):
+        old = baseline['routes'].get(name)
+        if old:
+            print "%-24s p50 %+7.1f%%  throughput %+7.1f%%" % (
+                name, (stats['p50_ms'] / old['p50_ms'] - 1) * 100,
+                (stats['throughput_rps'] / old['throughput_rps'] - 1) * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default="benchmark.db",
+                        help="SQLite file to seed and benchmark against")
+    parser.add_argument("--complimentees", default=10000, type=int)
+    parser.add_argument("--compliments", default=1000000, type=int)
+    parser.add_argument("--requests", default=200, type=int,
+                        help="requests per route")
+    parser.add_argument("--reuse", action="store_true",
+                        help="benchmark an already seeded database")
+    parser.add_argument("--route", action="append",
+                        help="only run these routes")
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = ('sqlite:///' +
+                                             os.path.abspath(args.database))
+    app.config['CSRF_ENABLED'] = False
+    app.config['RATE_LIMIT_ENABLED'] = False
+    if not args.reuse:
+        if os.path.exists(args.database):
+            os.remove(args.database)
+        start = time.time()
+        seed(args)
+        print "Seeded in %.1fs" % (time.time() - start)
+
+    anonymous = app.test_client()
+    admin = app.test_client()
+    admin.post('/login', data={'username': 'bench', 'password': 'bench'})
+
+    results = {'complimentees': args.complimentees,
+               'compliments': args.compliments,
+               'requests': args.requests,
+               'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'routes': {}}
+    print "%-24s %9s %9s %9s %9s %9s %9s" % (
+        "route", "p50 ms", "p95 ms", "p99 ms", "req/s", "queries", "rss kb")
+    for name, login, method, make_url, make_data in routes(args):
+        if args.route and name not in args.route:
+            continue
+        stats = run_route(admin if login else anonymous, method, make_url,
+                          make_data, args.requests)
+        results['routes'][name] = stats
+        print "%-24s %9.2f %9.2f %9.2f %9.1f %9.1f %9d" % (
+            name, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['throughput_rps'], stats['queries_per_request'],
+            stats['peak_rss_growth_kb'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
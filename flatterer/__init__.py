@@ -1,16 +1,35 @@
+from startup import StartupTimer, configure_templates
+startup_timer = StartupTimer()
+
 from flask import Flask, render_template, g
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.login import LoginManager
+from werkzeug.contrib.fixers import ProxyFix
 import sqlite3
 
+from database import RoutingSQLAlchemy, configure_sqlite
+startup_timer.mark('imports')
+
 app = Flask(__name__)
 app.config.from_object('config')
+configure_templates(app)
+if app.config.get('PROXY_COUNT'):
+    # Client addresses come from the X-Forwarded-For header the proxies
+    # add, so rate limits see the clients instead of the proxy.
+    app.wsgi_app = ProxyFix(app.wsgi_app, app.config['PROXY_COUNT'])
 
 login_manager = LoginManager()
 login_manager.setup_app(app)
 
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 db.init_app(app)
+configure_sqlite(app)
+startup_timer.mark('app')
 
 import models
 import views
+import assets
+import media
+import metrics
+import ratelimit
+import onboarding
+startup_timer.mark('modules')
@@ -0,0 +1,171 @@
+import time
+import atexit
+from datetime import datetime
+from collections import defaultdict
+from threading import Condition
+
+from sqlalchemy import text, func, case
+
+from flatterer import app, db
+from models import ComplimenteeViews
+from util import ProcessThread
+
+# Rows per upsert statement; keeps SQLite under its 999 bound parameters.
+UPSERT_ROWS = 300
+
+UPSERT_SQL = {
+    'sqlite': "ON CONFLICT (complimentee_id, bucket) DO UPDATE SET "
+              "views = complimentee_views.views + excluded.views",
+    'postgresql': "ON CONFLICT (complimentee_id, bucket) DO UPDATE SET "
+                  "views = complimentee_views.views + excluded.views",
+    'mysql': "ON DUPLICATE KEY UPDATE views = views + VALUES(views)",
+}
+
+
+class ViewCounter(ProcessThread):
+    """Counts page views in memory and adds them to the database later.
+
+    Views are counted per complimentee and `bucket_seconds` long time
+    bucket. A background thread in each process writes them every
+    `interval` seconds, or sooner once `max_keys` counters are held.
+    Counting a view never touches the database.
+    """
+
+    def __init__(self, bucket_seconds=3600, interval=30, max_keys=10000):
+        self.bucket_seconds = bucket_seconds
+        self.interval = interval
+        self.max_keys = max_keys
+        self.counts = defaultdict(int)
+        self._cond = Condition()
+        self._closing = False
+
+    def record(self, complimentee_id, now=None):
+        now = now or time.time()
+        bucket = int(now) - int(now) % self.bucket_seconds
+        with self._cond:
+            self.start()
+            self.counts[(complimentee_id, bucket)] += 1
+            if len(self.counts) >= self.max_keys:
+                self._cond.notify()
+
+    def prepare_process(self):
+        # Counts inherited from the parent are the parent's to write.
+        self.counts = defaultdict(int)
+        self._closing = False
+
+    def close(self):
+        """Writes the remaining counts and stops the flusher."""
+        with self._cond:
+            if not self.running_here() or self._closing:
+                return
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+
+    def run(self):
+        while True:
+            with self._cond:
+                if not self._closing and len(self.counts) < self.max_keys:
+                    self._cond.wait(self.interval)
+                counts, self.counts = self.counts, defaultdict(int)
+                closing = self._closing
+            try:
+                self.flush(counts)
+            except Exception:
+                app.logger.exception("Could not write %d view counts",
+                                     len(counts))
+                with self._cond:
+                    for key, views in counts.items():
+                        self.counts[key] += views
+            if closing:
+                return
+
+    def flush(self, counts):
+        """Adds counts to complimentee_views, one upsert per chunk of rows."""
+        rows = sorted(counts.items())
+        if not rows:
+            return
+        dialect = db.engine.dialect.name
+        with db.engine.begin() as connection:
+            for start in range(0, len(rows), UPSERT_ROWS):
+                chunk = rows[start:start + UPSERT_ROWS]
+                if dialect in UPSERT_SQL:
+                    connection.execute(*upsert(chunk, UPSERT_SQL[dialect]))
+                else:
+                    for (complimentee_id, bucket), views in chunk:
+                        add_views(connection, complimentee_id, bucket, views)
+
+
+def upsert(rows, conflict_clause):
+    """Builds one multi-row INSERT adding `rows` to existing counts."""
+    values, params = [], {}
+    for i, ((complimentee_id, bucket), views) in enumerate(rows):
+        values.append('(:c%d, :b%d, :v%d)' % (i, i, i))
+        params.update({'c%d' % i: complimentee_id, 'b%d' % i: bucket,
+                       'v%d' % i: views})
+    statement = ("INSERT INTO complimentee_views "
+                 "(complimentee_id, bucket, views) VALUES %s %s"
+                 % (', '.join(values), conflict_clause))
+    return text(statement), params
+
+
+def add_views(connection, complimentee_id, bucket, views):
+    """Adds views to one counter, for databases without an upsert."""
+    table = ComplimenteeViews.__table__
+    updated = connection.execute(
+        table.update()
+        .where(table.c.complimentee_id == complimentee_id)
+        .where(table.c.bucket == bucket)
+        .values(views=table.c.views + views))
+    if not updated.rowcount:
+        connection.execute(table.insert(), complimentee_id=complimentee_id,
+                           bucket=bucket, views=views)
+
+
+def view_counts(complimentee_ids, since=None):
+    """Returns {complimentee_id: (total views, views since `since`)}.
+
+    `since` is a datetime and is rounded down to its time bucket. Views
+    from the last flush interval aren't written yet, so aren't included.
+    """
+    if not complimentee_ids:
+        return {}
+    since = to_timestamp(since) if since else 0
+    recent = func.sum(case([(ComplimenteeViews.bucket >= since,
+                             ComplimenteeViews.views)], else_=0))
+    rows = (db.session.query(ComplimenteeViews.complimentee_id,
+                             func.sum(ComplimenteeViews.views), recent)
+            .filter(ComplimenteeViews.complimentee_id.in_(complimentee_ids))
+            .group_by(ComplimenteeViews.complimentee_id))
+    counts = dict((complimentee_id, (0, 0))
+                  for complimentee_id in complimentee_ids)
+    for complimentee_id, total, recent in rows:
+        counts[complimentee_id] = (int(total or 0), int(recent or 0))
+    return counts
+
+
+def view_history(complimentee_id, since=None, until=None):
+    """Returns [(bucket start datetime, views)] for a complimentee."""
+    query = (db.session.query(ComplimenteeViews.bucket,
+                              ComplimenteeViews.views)
+             .filter(ComplimenteeViews.complimentee_id == complimentee_id)
+             .order_by(ComplimenteeViews.bucket))
+    if since:
+        query = query.filter(ComplimenteeViews.bucket >= to_timestamp(since))
+    if until:
+        query = query.filter(ComplimenteeViews.bucket < to_timestamp(until))
+    return [(datetime.utcfromtimestamp(bucket), views)
+            for bucket, views in query]
+
+
+def to_timestamp(value):
+    """Converts a naive UTC datetime to its bucket's Unix time."""
+    seconds = int((value - datetime(1970, 1, 1)).total_seconds())
+    return seconds - seconds % view_counter.bucket_seconds
+
+
+view_counter = ViewCounter(
+    bucket_seconds=app.config.get('VIEW_COUNT_BUCKET_SECONDS', 3600),
+    interval=app.config.get('VIEW_COUNT_FLUSH_INTERVAL', 30),
+    max_keys=app.config.get('VIEW_COUNT_MAX_KEYS', 10000))
+atexit.register(view_counter.close)
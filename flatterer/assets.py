@@ -0,0 +1,182 @@
+import os
+import json
+import gzip
+import hashlib
+import mimetypes
+from StringIO import StringIO
+
+from flask import request, send_from_directory, url_for
+
+from flatterer import app
+from util import atomic_write
+
+# Optional: brotli adds .br siblings, PIL resizes the background images.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.json', '.txt')
+BACKGROUND_IMAGES = ('BG.jpg', 'BG1.jpg')
+BACKGROUND_WIDTHS = (768, 1280, 1920)
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# Maps static filenames (and "name@width" background variants) to their
+# fingerprinted names under the build folder.
+manifest = {}
+
+
+def build_folder():
+    return (app.config.get('ASSET_BUILD_DIR') or
+            os.path.join(app.static_folder, 'build'))
+
+
+def fingerprint(name, data, suffix=''):
+    """Returns `name` with a content hash (and suffix) before its extension."""
+    root, ext = os.path.splitext(name)
+    return '%s%s.%s%s' % (root, suffix, hashlib.md5(data).hexdigest()[:12],
+                          ext)
+
+
+def write_asset(name, data):
+    """Writes a built asset along with its precompressed siblings."""
+    path = os.path.join(build_folder(), name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    if name.endswith(COMPRESSIBLE):
+        # A fixed mtime keeps rebuilds of unchanged files byte-identical.
+        gz = gzip.GzipFile(path + '.gz', 'wb', 9, mtime=0)
+        gz.write(data)
+        gz.close()
+        if brotli:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data))
+
+
+def optimize_image(data, width=None):
+    """Recompresses a JPEG, resized to `width` pixels wide if given.
+
+    Returns None when that would not make the image any smaller.
+    """
+    image = Image.open(StringIO(data))
+    if width:
+        if image.size[0] <= width:
+            return None
+        height = image.size[1] * width // image.size[0]
+        image = image.resize((width, height), Image.ANTIALIAS)
+    out = StringIO()
+    image.convert('RGB').save(out, 'JPEG', quality=80, optimize=True,
+                              progressive=True)
+    if not width and out.tell() >= len(data):
+        return None
+    return out.getvalue()
+
+
+def build_assets():
+    """Builds fingerprinted, precompressed copies of every static file.
+
+    The results go to the build folder, static/build unless ASSET_BUILD_DIR
+    says otherwise, along with a manifest.json mapping the original names
+    to the built ones. Built files are named by content, so rebuilding over
+    an old build is safe while it is being served.
+    """
+    built = {}
+    folder = os.path.abspath(build_folder())
+    for root, dirs, files in os.walk(app.static_folder):
+        dirs[:] = [name for name in dirs
+                   if os.path.abspath(os.path.join(root, name)) != folder]
+        for filename in files:
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, app.static_folder).replace(os.sep,
+                                                                    '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            if name in BACKGROUND_IMAGES and Image:
+                data = optimize_image(data) or data
+                for width in BACKGROUND_WIDTHS:
+                    variant = optimize_image(data, width)
+                    if variant:
+                        variant_name = fingerprint(name, variant,
+                                                   '.%dw' % width)
+                        write_asset(variant_name, variant)
+                        built['%s@%d' % (name, width)] = variant_name
+
+            built[name] = fingerprint(name, data)
+            write_asset(built[name], data)
+
+    with atomic_write(os.path.join(build_folder(), 'manifest.json'),
+                      'w') as f:
+        json.dump(built, f, indent=2, sort_keys=True)
+    manifest.clear()
+    manifest.update(built)
+    return built
+
+
+def load_manifest():
+    """Loads the asset manifest, if assets have been built."""
+    path = os.path.join(build_folder(), 'manifest.json')
+    if os.path.isfile(path):
+        with open(path) as f:
+            manifest.clear()
+            manifest.update(json.load(f))
+
+
+def asset_url_for(endpoint, **values):
+    """url_for that points static files at their fingerprinted builds."""
+    if endpoint == 'static' and values.get('filename') in manifest:
+        values['filename'] = manifest[values['filename']]
+        endpoint = 'assets'
+    return url_for(endpoint, **values)
+
+
+def static_variant(filename, width):
+    """Returns the URL of a resized image, or of the original if none."""
+    if '%s@%d' % (filename, width) in manifest:
+        return url_for('assets', filename=manifest['%s@%d' % (filename,
+                                                               width)])
+    return asset_url_for('static', filename=filename)
+
+
+@app.context_processor
+def override_url_for():
+    return dict(url_for=asset_url_for, static_variant=static_variant)
+
+
+@app.route('/assets/<path:filename>')
+def assets(filename):
+    """Serves built assets, precompressed when the client accepts it.
+
+    Built names change with their content, so they can be cached forever.
+    """
+    folder = build_folder()
+    accepted = request.accept_encodings
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if (accepted[encoding] > 0 and
+                os.path.isfile(os.path.join(folder, filename + suffix))):
+            response = send_from_directory(
+                folder, filename + suffix,
+                mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(folder, filename)
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = ('public, max-age=%d, immutable'
+                                         % ONE_YEAR)
+    return response
+
+
+if app.config.get('BUILD_ASSETS_ON_STARTUP'):
+    build_assets()
+else:
+    load_manifest()
@@ -0,0 +1,166 @@
+import csv
+import json
+from itertools import islice
+
+from flatterer import db
+from models import Compliment, text_hash
+
+
+# Largest number of ids bound into a single IN clause. SQLite refuses
+# statements with more than 999 parameters.
+CHUNK_SIZE = 500
+
+EXPORT_FIELDS = ['id', 'compliment', 'gender', 'user_id', 'approved']
+
+
+def chunked(iterable, size):
+    """Yields lists of at most `size` items from an iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def delete_compliments(compliment_ids):
+    """Deletes compliments by id with one DELETE per chunk of ids."""
+    for chunk in chunked(compliment_ids, CHUNK_SIZE):
+        (Compliment.query
+         .filter(Compliment.id.in_(chunk))
+         .delete(synchronize_session=False))
+
+
+def approve_compliment_ids(compliment_ids):
+    """Approves compliments by id with one UPDATE per chunk of ids."""
+    for chunk in chunked(compliment_ids, CHUNK_SIZE):
+        (Compliment.query
+         .filter(Compliment.id.in_(chunk))
+         .update({'approved': True}, synchronize_session=False))
+
+
+def unapproved_compliments(compliment_ids):
+    """Returns (id, compliment, gender, user_id) of the unapproved ones."""
+    rows = []
+    for chunk in chunked(compliment_ids, CHUNK_SIZE):
+        rows.extend(Compliment.query
+                    .with_entities(Compliment.id, Compliment.compliment,
+                                   Compliment.gender, Compliment.user_id)
+                    .filter(Compliment.id.in_(chunk))
+                    .filter(Compliment.approved == False))
+    return rows
+
+
+def complimentee_ids(compliment_ids):
+    """Returns the ids of the complimentees some compliments are for."""
+    ids = set()
+    for chunk in chunked(compliment_ids, CHUNK_SIZE):
+        ids.update(user_id for user_id, in
+                   Compliment.query
+                   .with_entities(Compliment.user_id)
+                   .filter(Compliment.id.in_(chunk))
+                   .filter(Compliment.user_id != None)
+                   .distinct())
+    return ids
+
+
+def iter_compliments(batch_size=1000):
+    """Yields every compliment as a dict, walking the table by id.
+
+    Only one batch of rows is held in memory at a time.
+    """
+    table = Compliment.__table__
+    last_id = 0
+    while True:
+        rows = db.session.execute(table.select()
+                                  .where(table.c.id > last_id)
+                                  .order_by(table.c.id)
+                                  .limit(batch_size)).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield dict((field, row[field]) for field in EXPORT_FIELDS)
+        last_id = rows[-1]['id']
+
+
+def export_compliments(out, format='jsonl', batch_size=1000):
+    """Writes every compliment to a file object as CSV or JSON lines.
+
+    Returns the number of compliments written.
+    """
+    count = 0
+    if format == 'csv':
+        writer = csv.DictWriter(out, EXPORT_FIELDS)
+        writer.writerow(dict(zip(EXPORT_FIELDS, EXPORT_FIELDS)))
+    for compliment in iter_compliments(batch_size):
+        if format == 'csv':
+            if compliment['compliment'] is not None:
+                compliment['compliment'] = (compliment['compliment']
+                                            .encode('utf-8'))
+            writer.writerow(compliment)
+        else:
+            out.write(json.dumps(compliment) + '\n')
+        count += 1
+    return count
+
+
+def read_compliments(infile, format='jsonl'):
+    """Yields compliments as insertable dicts from a CSV or JSON lines file."""
+    if format == 'csv':
+        records = csv.DictReader(infile)
+    else:
+        records = (json.loads(line) for line in infile if line.strip())
+
+    for record in records:
+        approved = record.get('approved')
+        if isinstance(approved, basestring):
+            approved = approved.strip().lower() in ('1', 'true', 'yes')
+        user_id = record.get('user_id')
+        compliment = record['compliment']
+        if isinstance(compliment, str):
+            compliment = compliment.decode('utf-8')
+        yield {'compliment': compliment,
+               'text_hash': text_hash(compliment),
+               'gender': record.get('gender') or None,
+               'user_id': int(user_id) if user_id else None,
+               'approved': bool(approved)}
+
+
+def new_compliments(records):
+    """Returns the records that aren't already compliments, once each.
+
+    Compliments are the same when they have the same text hash and
+    complimentee, as in is_duplicate.
+    """
+    hashes = set(record['text_hash'] for record in records)
+    seen = set()
+    for chunk in chunked(hashes, CHUNK_SIZE):
+        seen.update(Compliment.query
+                    .with_entities(Compliment.text_hash, Compliment.user_id)
+                    .filter(Compliment.text_hash.in_(chunk)))
+    rows = []
+    for record in records:
+        key = (record['text_hash'], record['user_id'])
+        if key not in seen:
+            seen.add(key)
+            rows.append(record)
+    return rows
+
+
+def import_compliments(infile, format='jsonl', batch_size=1000):
+    """Inserts compliments from a CSV or JSON lines file.
+
+    Rows are inserted with one executemany INSERT and one commit per batch.
+    Ids from the file are ignored, and so are compliments that are already
+    in the table or earlier in the file. Returns the number of compliments
+    added.
+    """
+    count = 0
+    insert = Compliment.__table__.insert()
+    for batch in chunked(read_compliments(infile, format), batch_size):
+        rows = new_compliments(batch)
+        if rows:
+            db.session.execute(insert, rows)
+        db.session.commit()
+        count += len(rows)
+    return count
@@ -0,0 +1,222 @@
+import time
+import random
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+from flatterer import app
+from database import primary_reads
+from models import Compliment
+
+
+# Compact, read-only stand-in for a Compliment row.
+PooledCompliment = namedtuple('PooledCompliment', ['id', 'compliment'])
+
+
+class ComplimentPool(object):
+    """Keyed cache of compliment pools, e.g. per gender or per complimentee.
+
+    Entries are loaded on first use and kept until they are invalidated,
+    older than `ttl` seconds, or the least recently used of more than
+    `size` keys. Each key is loaded by one thread at a time, without
+    holding up other keys. A load that an invalidation lands in the middle
+    of is returned but not kept, since it may predate the change.
+    """
+
+    def __init__(self, loader, ttl=300, size=1000):
+        self.loader = loader
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Bumped by invalidate(), for all keys and for each key.
+        self._generation = 0
+        self._key_generations = {}
+        # [lock, waiting threads] per key, only while it is being loaded.
+        self._loads = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        """Returns the tuple of compliments for a key."""
+        now = time.time()
+        compliments = self._cached(key, now)
+        if compliments is not None:
+            return compliments
+
+        with self._lock:
+            load = self._loads.setdefault(key, [Lock(), 0])
+            load[1] += 1
+        try:
+            with load[0]:
+                # Another thread may have reloaded this key meanwhile.
+                compliments = self._cached(key, now)
+                if compliments is not None:
+                    return compliments
+                self.misses += 1
+                generation = self.generation(key)
+                compliments = tuple(self.loader(key))
+                with self._lock:
+                    if self.generation(key) == generation:
+                        self._entries.pop(key, None)
+                        self._entries[key] = (time.time(), compliments)
+                        while len(self._entries) > self.size:
+                            self._entries.popitem(last=False)
+                return compliments
+        finally:
+            with self._lock:
+                load[1] -= 1
+                if not load[1]:
+                    del self._loads[key]
+
+    def _cached(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or now - entry[0] >= self.ttl:
+                return None
+            # Re-inserting marks the key as most recently used.
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, key):
+        return self._generation, self._key_generations.get(key, 0)
+
+    def invalidate(self, key=None):
+        """Drops one key from the cache, or all of them."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._key_generations.clear()
+                self._generation += 1
+            else:
+                self._entries.pop(key, None)
+                self._key_generations[key] = (
+                    self._key_generations.get(key, 0) + 1)
+
+    def stats(self):
+        """Returns the hit/miss counters and cached pool sizes."""
+        with self._lock:
+            entries = self._entries.items()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'sizes': dict((key, len(entry[1]))
+                              for key, entry in entries)}
+
+
+class LRUCache(object):
+    """LRU cache of values such as rendered pages or users.
+
+    Holds at most `size` values, each for at most `ttl` seconds.
+    """
+
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Returns the cached value for a key, or None."""
+        with self._lock:
+            entry = self._values.pop(key, None)
+            if entry is None or time.time() - entry[0] >= self.ttl:
+                self.misses += 1
+                return None
+            # Re-inserting marks the value as most recently used.
+            self._values[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Caches a value, evicting the least recently used one if full."""
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (time.time(), value)
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Drops one value from the cache, or all of them."""
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+    def stats(self):
+        """Returns the hit/miss counters and number of cached values."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._values)}
+
+
+def load_approved_compliments(gender):
+    """Loads the approved compliments for a gender as PooledCompliments."""
+    with primary_reads():
+        rows = (Compliment.query
+                .with_entities(Compliment.id, Compliment.compliment)
+                .filter_by(gender=gender)
+                .filter_by(approved=True)
+                .all())
+    return [PooledCompliment(*row) for row in rows]
+
+
+def load_personal_compliments(user_id):
+    """Loads the compliments written for a complimentee."""
+    with primary_reads():
+        rows = (Compliment.query
+                .with_entities(Compliment.id, Compliment.compliment)
+                .filter_by(user_id=user_id)
+                .all())
+    return [PooledCompliment(*row) for row in rows]
+
+
+def sample_compliments(pools, count):
+    """Picks up to `count` random compliments across several pools.
+
+    Only the picked indexes are generated, so the pools are never copied
+    or shuffled.
+    """
+    total = sum(len(pool) for pool in pools)
+    picks = []
+    for index in random.sample(xrange(total), min(count, total)):
+        for pool in pools:
+            if index < len(pool):
+                picks.append(pool[index])
+                break
+            index -= len(pool)
+    return picks
+
+
+_ttl = app.config.get('COMPLIMENT_POOL_TTL', 300)
+_size = app.config.get('COMPLIMENT_POOL_SIZE', 1000)
+
+if app.config.get('COMPLIMENT_SNAPSHOT_PATH'):
+    # One memory-mapped copy shared by every worker process.
+    from snapshot import SnapshotPool, snapshot_reader, snapshot_writer
+    compliment_pool = SnapshotPool(
+        'gender', snapshot_reader, snapshot_writer,
+        ComplimentPool(load_approved_compliments, ttl=_ttl, size=_size))
+    personal_pool = SnapshotPool(
+        'user', snapshot_reader, snapshot_writer,
+        ComplimentPool(load_personal_compliments, ttl=_ttl, size=_size))
+else:
+    # Approved compliments keyed by gender.
+    compliment_pool = ComplimentPool(load_approved_compliments, ttl=_ttl,
+                                     size=_size)
+    # Personal compliments keyed by complimentee id.
+    personal_pool = ComplimentPool(load_personal_compliments, ttl=_ttl,
+                                   size=_size)
+# Rendered /compliment/<user_url> pages keyed by user_url.
+page_cache = LRUCache(size=app.config.get('PAGE_CACHE_SIZE', 1000),
+                      ttl=app.config.get('PAGE_CACHE_TTL', 300))
+# Detached User rows keyed by id, for the Flask-Login user_loader.
+user_cache = LRUCache(size=app.config.get('USER_CACHE_SIZE', 1000),
+                      ttl=app.config.get('USER_CACHE_TTL', 60))
+# Detached Complimentee rows, with their theme loaded, keyed by url.
+complimentee_cache = LRUCache(
+    size=app.config.get('COMPLIMENTEE_CACHE_SIZE', 1000),
+    ttl=app.config.get('COMPLIMENTEE_CACHE_TTL', 30))
@@ -0,0 +1,90 @@
+import zlib
+
+from flask import request, Response, stream_with_context
+
+from flatterer import app
+from assets import brotli
+
+COMPRESSIBLE_TYPES = ('text/html', 'text/plain', 'text/css', 'text/xml',
+                      'application/json', 'application/javascript')
+
+
+def choose_encoding():
+    """Picks the best encoding the client accepts: br, then gzip."""
+    accepted = request.accept_encodings
+    if brotli and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compressor(encoding):
+    """Returns (compress, flush, finish) functions for an encoding."""
+    if encoding == 'br':
+        brotli_compressor = brotli.Compressor(
+            quality=app.config.get('COMPRESSION_BROTLI_QUALITY', 5))
+        return (brotli_compressor.process, brotli_compressor.flush,
+                brotli_compressor.finish)
+    # wbits 31 writes a gzip header and trailer.
+    gzip_compressor = zlib.compressobj(
+        app.config.get('COMPRESSION_LEVEL', 6), zlib.DEFLATED, 31)
+    return (gzip_compressor.compress,
+            lambda: gzip_compressor.flush(zlib.Z_SYNC_FLUSH),
+            gzip_compressor.flush)
+
+
+def compress_stream(chunks, encoding):
+    """Compresses chunks as they come, sending each on straight away."""
+    compress, flush, finish = compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = compress(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+@app.after_request
+def compress_response(response):
+    """Compresses text responses for clients that accept it.
+
+    Buffered responses smaller than COMPRESSION_MIN_SIZE are left alone.
+    Streamed responses have no size up front and are always compressed,
+    chunk by chunk, so they still start arriving before rendering ends.
+    """
+    if (not app.config.get('COMPRESSION_ENABLED', True) or
+            response.mimetype not in COMPRESSIBLE_TYPES or
+            response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            response.status_code < 200 or
+            response.status_code in (204, 206, 304)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config.get('COMPRESSION_MIN_SIZE', 1024):
+            return response
+        response.set_data(''.join(compress_stream([data], encoding)))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but sends the page while it is rendered.
+
+    Output is sent in chunks of about STREAM_BUFFER_SIZE template events,
+    so memory use doesn't grow with the size of the page.
+    """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(app.config.get('STREAM_BUFFER_SIZE', 50))
+    return Response(stream_with_context(stream), mimetype='text/html')
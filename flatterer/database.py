@@ -0,0 +1,96 @@
+import sqlite3
+from functools import partial
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+
+
+class RoutingSession(_SignallingSession):
+    """Session sending reads to the replica during read-only requests.
+
+    A request is read-only once a view marked with `read_only` runs.
+    Flushes always go to the primary.
+
+    Flask-SQLAlchemy's binds pick an engine per model and its
+    session_options can't change the session class, so this extends its
+    private _SignallingSession; requirements.txt pins the version it
+    was written against.
+    """
+
+    def __init__(self, db, *args, **kwargs):
+        self.db = db
+        self.writing = False
+        _SignallingSession.__init__(self, db, *args, **kwargs)
+
+    def flush(self, objects=None):
+        writing, self.writing = self.writing, True
+        try:
+            _SignallingSession.flush(self, objects)
+        finally:
+            self.writing = writing
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self.app.config.get('DATABASE_REPLICA_URI') and
+                not self.writing and has_request_context() and
+                getattr(g, 'read_replica', False)):
+            return self.db.get_engine(self.app, bind='replica')
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension adding engine options and replica routing."""
+
+    def init_app(self, app):
+        SQLAlchemy.init_app(self, app)
+        replica = app.config.get('DATABASE_REPLICA_URI')
+        if replica:
+            binds = app.config['SQLALCHEMY_BINDS'] or {}
+            binds['replica'] = replica
+            app.config['SQLALCHEMY_BINDS'] = binds
+
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options),
+                                  scopefunc=scopefunc)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        # SQLite uses its own pool without these settings.
+        if info.drivername != 'sqlite':
+            options.update(app.config.get('DATABASE_CONNECT_OPTIONS') or {})
+
+
+@contextmanager
+def primary_reads(enabled=True):
+    """Sends the queries run inside it to the primary, even in read-only views.
+
+    For results that are cached: an invalidated entry reloaded from a
+    replica that is behind would otherwise stay stale until it expires.
+    """
+    if not enabled or not has_request_context():
+        yield
+        return
+    replica, g.read_replica = getattr(g, 'read_replica', False), False
+    try:
+        yield
+    finally:
+        g.read_replica = replica
+
+
+def configure_sqlite(app):
+    """Applies SQLITE_PRAGMAS to every new SQLite connection."""
+    pragmas = app.config.get('SQLITE_PRAGMAS') or {}
+
+    @event.listens_for(Engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for pragma, value in sorted(pragmas.items()):
+            cursor.execute('PRAGMA %s = %s' % (pragma, value))
+        cursor.close()
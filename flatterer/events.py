@@ -0,0 +1,409 @@
+import os
+import json
+import time
+import fcntl
+import errno
+import select
+import socket
+from collections import deque
+from threading import Lock, Event
+
+from flask import request, Response, abort
+
+from flatterer import app
+from util import ProcessThread
+
+HEARTBEAT = ': ping\n\n'
+
+
+def events_enabled():
+    return app.config.get('EVENTS_ENABLED', True)
+
+
+def format_event(event, data):
+    """Formats a server-sent event carrying JSON data."""
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+
+class Client(object):
+    """A viewer of some channels, with a bounded buffer of unsent events.
+
+    Once the buffer holds `max_buffer` events the oldest are dropped, so
+    a slow viewer can't make the hub hold more and more.
+    """
+
+    def __init__(self, channels, max_buffer):
+        self.channels = channels
+        self.pending = deque(maxlen=max_buffer)
+        self.ready = Event()
+        self.dropped = 0
+        # Set once the hub writes to the viewer's socket itself.
+        self.connection = None
+        self.out = ''
+        self.last_sent = time.time()
+
+    def push(self, message):
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append(message)
+        self.ready.set()
+
+    def take(self):
+        messages = []
+        while self.pending:
+            messages.append(self.pending.popleft())
+        return messages
+
+    def wait(self, timeout):
+        """Blocks until events arrive or `timeout` passes; returns them."""
+        self.ready.wait(timeout)
+        self.ready.clear()
+        return self.take()
+
+
+class EventHub(ProcessThread):
+    """Fans published events out to the viewers of each channel.
+
+    Viewers whose connection has been handed over with `attach` are
+    written to by one hub thread polling their sockets, so an idle viewer
+    costs a socket and its buffer rather than a thread. Events are shared
+    with the other processes through `log_path`, an append-only file the
+    hub thread of every process with viewers reads every `poll_interval`
+    seconds; without it, events only reach this process's viewers.
+    """
+
+    def __init__(self, max_connections=1000, max_buffer=50, heartbeat=15,
+                 log_path=None, log_max_bytes=1024 * 1024,
+                 poll_interval=0.5):
+        self.max_connections = max_connections
+        self.max_buffer = max_buffer
+        self.heartbeat = heartbeat
+        self.log_path = log_path
+        self.log_max_bytes = log_max_bytes
+        self.poll_interval = poll_interval
+        self.published = 0
+        self.refused = 0
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.channels = {}
+        self.connections = 0
+        self._attaching = deque()
+        self._sockets = {}
+        self._log = None
+        self._partial = ''
+        self._wake_read = self._wake_write = None
+
+    def prepare_process(self):
+        # Viewers inherited from the parent are the parent's.
+        self.reset()
+        self._wake_read, self._wake_write = os.pipe()
+        for fd in (self._wake_read, self._wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        if self.log_path:
+            # Only events published from now on are wanted.
+            self._log = self.open_log()
+            os.lseek(self._log, 0, os.SEEK_END)
+
+    def subscribe(self, channels):
+        """Returns a Client for some channels, or None if the hub is full."""
+        with self._lock:
+            self.start()
+            if self.connections >= self.max_connections:
+                self.refused += 1
+                return None
+            self.connections += 1
+            client = Client(channels, self.max_buffer)
+            for channel in channels:
+                self.channels.setdefault(channel, set()).add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            if not self.running_here():
+                return
+            for channel in client.channels:
+                clients = self.channels.get(channel)
+                if clients and client in clients:
+                    clients.discard(client)
+                    if not clients:
+                        del self.channels[channel]
+            self.connections -= 1
+
+    def attach(self, client, connection):
+        """Hands a viewer's socket, headers already sent, to the hub."""
+        connection.setblocking(False)
+        client.connection = connection
+        self._attaching.append(client)
+        self.wake()
+
+    def wake(self):
+        if self.running_here():
+            try:
+                os.write(self._wake_write, 'x')
+            except OSError as e:
+                # A full pipe means the hub is awake anyway.
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def publish(self, messages):
+        """Sends (channel, message) pairs to every viewer of the channels."""
+        if not messages:
+            return
+        self.published += len(messages)
+        if not self.log_path:
+            self.deliver(messages)
+            return
+        # The hub threads deliver them, including this process's.
+        self.append_log(''.join(json.dumps(message) + '\n'
+                                for message in messages))
+        self.wake()
+
+    def deliver(self, messages):
+        with self._lock:
+            for channel, message in messages:
+                for client in self.channels.get(channel, ()):
+                    client.push(message)
+        self.wake()
+
+    def append_log(self, data):
+        """Appends to the event log, starting a new one when it's full."""
+        while True:
+            fd = os.open(self.log_path,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(self.log_path).st_ino
+                except OSError:
+                    current = None
+                if current != os.fstat(fd).st_ino:
+                    # Rotated while waiting for the lock; readers have
+                    # moved on to the new file.
+                    continue
+                if os.fstat(fd).st_size >= self.log_max_bytes:
+                    os.rename(self.log_path, self.log_path + '.1')
+                    continue
+                os.write(fd, data)
+                return
+            finally:
+                os.close(fd)
+
+    def open_log(self):
+        # Created if need be, so a reader always holds the file that is
+        # being appended to, and reads it to the end when it is rotated.
+        return os.open(self.log_path, os.O_RDONLY | os.O_CREAT, 0644)
+
+    def read_log(self):
+        """Delivers events appended to the log since the last read."""
+        messages = []
+        try:
+            while True:
+                if self._log is None:
+                    # Tried again on the next read if this fails.
+                    self._log = self.open_log()
+                messages.extend(self.parse_log(self.read_all(self._log)))
+                try:
+                    rotated = (os.stat(self.log_path).st_ino !=
+                               os.fstat(self._log).st_ino)
+                except OSError:
+                    rotated = True
+                if not rotated:
+                    break
+                # Nothing is appended to the old file once it is renamed,
+                # so this reads the last of it.
+                messages.extend(self.parse_log(self.read_all(self._log)))
+                os.close(self._log)
+                self._log = None
+                self._partial = ''
+        finally:
+            if messages:
+                self.deliver(messages)
+
+    def read_all(self, fd):
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    def parse_log(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        messages = []
+        for line in lines:
+            if line:
+                channel, message = json.loads(line)
+                messages.append((channel, message.encode('utf-8')))
+        return messages
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self._wake_read, select.POLLIN)
+        writing = set()
+        next_heartbeat = time.time() + self.heartbeat
+        while True:
+            timeout = (self.poll_interval if self.log_path
+                       else self.heartbeat / 2.0)
+            try:
+                events = poller.poll(timeout * 1000)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wake_read:
+                    try:
+                        os.read(self._wake_read, 4096)
+                    except OSError:
+                        pass
+                    continue
+                client = self._sockets.get(fd)
+                if not client:
+                    continue
+                if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                    # Viewers send nothing, so this is them hanging up.
+                    if not self.check_open(client):
+                        self.drop(poller, writing, client)
+                        continue
+                if event & select.POLLOUT:
+                    self.send(poller, writing, client)
+
+            while self._attaching:
+                client = self._attaching.popleft()
+                fd = client.connection.fileno()
+                self._sockets[fd] = client
+                poller.register(fd, select.POLLIN)
+            if self.log_path:
+                try:
+                    self.read_log()
+                except Exception:
+                    app.logger.exception("Could not read the event log")
+
+            now = time.time()
+            if now >= next_heartbeat:
+                next_heartbeat = now + self.heartbeat / 2.0
+                for client in self._sockets.values():
+                    if now - client.last_sent >= self.heartbeat:
+                        client.push(HEARTBEAT)
+            for fd, client in self._sockets.items():
+                if fd not in writing and (client.pending or client.out):
+                    self.send(poller, writing, client)
+
+    def check_open(self, client):
+        try:
+            return bool(client.connection.recv(4096))
+        except socket.error as e:
+            return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+    def send(self, poller, writing, client):
+        """Writes what a viewer has pending; waits for POLLOUT if stuck."""
+        fd = client.connection.fileno()
+        if not client.out:
+            client.out = ''.join(client.take())
+        try:
+            sent = client.connection.send(client.out)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.drop(poller, writing, client)
+                return
+            sent = 0
+        client.out = client.out[sent:]
+        if sent:
+            client.last_sent = time.time()
+        blocked = bool(client.out or client.pending)
+        if blocked and fd not in writing:
+            writing.add(fd)
+            poller.modify(fd, select.POLLIN | select.POLLOUT)
+        elif not blocked and fd in writing:
+            writing.discard(fd)
+            poller.modify(fd, select.POLLIN)
+
+    def drop(self, poller, writing, client):
+        fd = client.connection.fileno()
+        poller.unregister(fd)
+        writing.discard(fd)
+        del self._sockets[fd]
+        client.connection.close()
+        self.unsubscribe(client)
+
+    def stats(self):
+        return {'connections': self.connections,
+                'attached': len(self._sockets),
+                'published': self.published,
+                'refused': self.refused}
+
+
+def compliment_messages(compliments):
+    """Returns (channel, message) pairs announcing new compliments.
+
+    `compliments` holds (id, compliment, gender, user_id) rows.
+    """
+    messages = []
+    for id, compliment, gender, user_id in compliments:
+        channel = 'user:%d' % user_id if user_id else 'gender:%s' % gender
+        messages.append((channel, format_event(
+            'compliment', {'id': id, 'compliment': compliment})))
+    return messages
+
+
+def publish_compliments(compliments):
+    """Pushes new compliments to the viewers of their pages."""
+    if events_enabled():
+        event_hub.publish(compliment_messages(compliments))
+
+
+def event_stream(channels):
+    """Returns a server-sent event stream of some channels.
+
+    Under the PooledWSGIServer, the connection is handed to the hub once
+    the headers are out, freeing the request thread. Elsewhere the stream
+    keeps its thread, waking for events and heartbeats.
+    """
+    if not events_enabled():
+        abort(404)
+    client = event_hub.subscribe(channels)
+    if client is None:
+        response = Response("Too many viewers, please try again later.\n",
+                            503, mimetype='text/plain')
+        response.headers['Retry-After'] = str(
+            int(app.config.get('EVENT_RETRY_AFTER', 30)))
+        return response
+    detach = request.environ.get('flatterer.detach')
+    # Kept out of the request metrics, see MetricsMiddleware.
+    request.environ['flatterer.stream'] = True
+
+    def stream():
+        # Also makes the server send the headers before detaching.
+        yield HEARTBEAT
+        if detach:
+            event_hub.attach(client, detach())
+            return
+        while True:
+            yield ''.join(client.wait(event_hub.heartbeat)) or HEARTBEAT
+
+    def release():
+        # Once attached, the hub lets the viewer go when they hang up.
+        if client.connection is None:
+            event_hub.unsubscribe(client)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    # Closing the response releases the viewer's slot even when the body
+    # is never started, as for a HEAD request.
+    response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stops nginx buffering the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+event_hub = EventHub(
+    max_connections=app.config.get('EVENT_MAX_CONNECTIONS', 1000),
+    max_buffer=app.config.get('EVENT_BUFFER_SIZE', 50),
+    heartbeat=app.config.get('EVENT_HEARTBEAT', 15),
+    log_path=app.config.get('EVENT_LOG'),
+    log_max_bytes=app.config.get('EVENT_LOG_MAX_BYTES', 1024 * 1024),
+    poll_interval=app.config.get('EVENT_POLL_INTERVAL', 0.5))
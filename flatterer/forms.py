@@ -1,9 +1,28 @@
 from flask.ext.wtf import (Form, TextField, PasswordField, BooleanField,
                            SelectField)
-from flask.ext.wtf import Required, Email, EqualTo
+from flask.ext.wtf import Required, Email, EqualTo, ValidationError
 from models import User
 
 
+def url_problem(url):
+    """Returns why `url` can't be a complimentee url, or None.
+
+    Published pages are named after their url, so it can't hold a path
+    separator or start with a dot.
+    """
+    if '/' in url or '\\' in url:
+        return "url can not contain '/' or '\\'."
+    if url.startswith('.'):
+        return "url can not start with '.'."
+    return None
+
+
+def complimentee_url(form, field):
+    problem = url_problem(field.data or '')
+    if problem:
+        raise ValidationError(problem)
+
+
 class Register(Form):
     """Registration form."""
     name = TextField('name', [Required()])
@@ -16,7 +35,7 @@ class Register(Form):
 class AddComplimentee(Form):
     """Form to add a complimentee."""
     name = TextField('name', [Required()])
-    url = TextField('url', [Required()])
+    url = TextField('url', [Required(), complimentee_url])
     greeting = TextField('greeting')
 
 
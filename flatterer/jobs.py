@@ -0,0 +1,42 @@
+from threading import Thread, Lock
+
+from flatterer import app, db
+
+
+class BackgroundJob(object):
+    """Runs `func` in a background thread whenever it is scheduled.
+
+    Scheduling it while it runs makes it run once more afterwards, so a
+    burst of edits costs at most two runs.
+    """
+
+    def __init__(self, func, name):
+        self.func = func
+        self.name = name
+        self._lock = Lock()
+        self._pending = False
+        self._running = False
+
+    def schedule(self):
+        with self._lock:
+            self._pending = True
+            if self._running:
+                return
+            self._running = True
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                self._pending = False
+            try:
+                self.func()
+            except Exception:
+                app.logger.exception("Background job %s failed", self.name)
+            finally:
+                db.session.remove()
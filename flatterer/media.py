@@ -0,0 +1,356 @@
+import os
+import imghdr
+import shutil
+import socket
+import struct
+import httplib
+import urllib2
+import hashlib
+import tempfile
+from threading import Lock
+from urlparse import urlparse, urljoin
+
+from flask import request, send_file, url_for, abort
+
+from flatterer import app
+from models import Theme
+from assets import Image, optimize_image, BACKGROUND_WIDTHS
+from util import atomic_write
+
+ONE_DAY = 24 * 60 * 60
+
+# Networks media is never fetched from, as (network, prefix length):
+# private, loopback, link-local (cloud metadata services), shared,
+# multicast and reserved addresses.
+BLOCKED_IPV4 = [('0.0.0.0', 8), ('10.0.0.0', 8), ('100.64.0.0', 10),
+                ('127.0.0.0', 8), ('169.254.0.0', 16), ('172.16.0.0', 12),
+                ('192.0.0.0', 24), ('192.168.0.0', 16), ('198.18.0.0', 15),
+                ('224.0.0.0', 4), ('240.0.0.0', 4)]
+BLOCKED_IPV6 = [('::', 128), ('::1', 128), ('fc00::', 7), ('fe80::', 10),
+                ('ff00::', 8)]
+MAX_REDIRECTS = 5
+
+
+class MediaRefused(ValueError):
+    """Raised for media that must not be fetched or served."""
+
+
+def address_number(family, address):
+    """Returns an IP address as (integer, bits)."""
+    packed = socket.inet_pton(family, address)
+    high, low = struct.unpack('!QQ', packed.rjust(16, '\0'))
+    return (high << 64) | low, len(packed) * 8
+
+
+def in_network(family, address, network, prefix):
+    number, bits = address_number(family, address)
+    network, bits = address_number(family, network)
+    return number >> (bits - prefix) == network >> (bits - prefix)
+
+
+def public_address(family, address):
+    """Tells whether media may be fetched from an IP address."""
+    address = address.split('%')[0]
+    if family == socket.AF_INET6:
+        number, bits = address_number(family, address)
+        if number >> 32 == 0xffff:
+            # An IPv4-mapped address is the IPv4 address.
+            family = socket.AF_INET
+            address = socket.inet_ntop(family,
+                                       struct.pack('!I', number & 0xffffffff))
+    blocked = BLOCKED_IPV6 if family == socket.AF_INET6 else BLOCKED_IPV4
+    return not any(in_network(family, address, network, prefix)
+                   for network, prefix in blocked)
+
+
+def public_addresses(host, port):
+    """Resolves a host, raising MediaRefused unless all its addresses are
+    public.
+
+    Every address is checked, so a name can't pair a private address
+    with a public one.
+    """
+    try:
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise IOError("Could not resolve %s: %s" % (host, e))
+    for family, type, proto, name, sockaddr in addresses:
+        if (family not in (socket.AF_INET, socket.AF_INET6) or
+                not public_address(family, sockaddr[0])):
+            raise MediaRefused("%s resolves to %s, which is not public"
+                               % (host, sockaddr[0]))
+    return addresses
+
+
+def check_url(url):
+    """Raises MediaRefused unless `url` is http(s) on public addresses."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise MediaRefused("%s is not an http(s) URL" % url)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    public_addresses(parsed.hostname, port)
+
+
+def checked_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                       source_address=None):
+    """socket.create_connection, connecting only to public addresses.
+
+    The host is resolved once and the addresses checked are the ones
+    connected to, so DNS can't answer with a public address for the check
+    and a private one for the connection.
+    """
+    error = None
+    for family, type, proto, name, sockaddr in public_addresses(*address):
+        sock = socket.socket(family, type, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except socket.error as e:
+            error = e
+            sock.close()
+    raise error or socket.error("No addresses for %s" % address[0])
+
+
+class CheckedHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, *args, **kwargs):
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        self._create_connection = checked_connection
+
+
+class CheckedHTTPSConnection(httplib.HTTPSConnection):
+    """Certificates and SNI still use the host name, not the address."""
+
+    def __init__(self, *args, **kwargs):
+        httplib.HTTPSConnection.__init__(self, *args, **kwargs)
+        self._create_connection = checked_connection
+
+
+class CheckedHTTPHandler(urllib2.HTTPHandler):
+
+    def http_open(self, req):
+        return self.do_open(CheckedHTTPConnection, req)
+
+
+class CheckedHTTPSHandler(urllib2.HTTPSHandler):
+
+    def https_open(self, req):
+        return self.do_open(CheckedHTTPSConnection, req,
+                            context=self._context)
+
+
+class CheckedRedirectHandler(urllib2.HTTPRedirectHandler):
+    """Follows a few redirects, checking where each one leads.
+
+    The connection to the new location is checked again as it is made.
+    """
+    max_redirections = MAX_REDIRECTS
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(urljoin(req.get_full_url(), newurl))
+        return urllib2.HTTPRedirectHandler.redirect_request(
+            self, req, fp, code, msg, headers, newurl)
+
+
+class MediaCache(object):
+    """Local disk cache of remote theme media, with resized variants.
+
+    Once the folder holds more than `max_bytes`, the least recently used
+    files are removed first.
+    """
+
+    def __init__(self, folder, max_bytes, max_file_bytes, timeout=10,
+                 check_urls=True):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.timeout = timeout
+        # Only turned off to fetch from a local stand-in origin in tests.
+        self.check_urls = check_urls
+        # No proxies, so the addresses checked are the ones connected to.
+        handlers = [urllib2.ProxyHandler({})]
+        if check_urls:
+            handlers += [CheckedHTTPHandler, CheckedHTTPSHandler,
+                         CheckedRedirectHandler]
+        self._opener = urllib2.build_opener(*handlers)
+        self._lock = Lock()
+
+    def path(self, url, variant=None):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        if variant:
+            name += '.' + variant
+        return os.path.join(self.folder, name)
+
+    def get(self, url, width=None):
+        """Returns the path of a local copy of the image at `url`.
+
+        Images are recompressed, and resized to `width` if given, when that
+        makes them smaller. Raises IOError if the media can't be fetched
+        and MediaRefused if it is not an image or may not be fetched.
+        """
+        variant_path = self.path(url, '%dw' % width if width else 'opt')
+        if self.touch(variant_path):
+            return variant_path
+        original = self.path(url)
+        if not self.touch(original):
+            self.store(original, self.fetch(url))
+
+        with open(original, 'rb') as f:
+            data = f.read()
+        try:
+            if Image:
+                variant = optimize_image(data, width)
+            elif imghdr.what(None, data):
+                variant = None
+            else:
+                raise IOError("Unknown image type")
+        except IOError:
+            # Nothing but images is served from here.
+            self.remove(original)
+            raise MediaRefused("%s is not an image" % url)
+        if variant:
+            self.store(variant_path, variant)
+        else:
+            # Already as small as it gets, or narrower than `width`. Kept
+            # all the same, so later requests don't decode it again.
+            self.link(self.get(url) if width else original, variant_path)
+        return variant_path
+
+    def touch(self, path):
+        """Marks a cached file as recently used, if it exists."""
+        try:
+            os.utime(path, None)
+            return True
+        except OSError:
+            return False
+
+    def fetch(self, url):
+        if self.check_urls:
+            check_url(url)
+        response = self._opener.open(url, timeout=self.timeout)
+        try:
+            content_type = response.info().gettype()
+            if not content_type.startswith('image/'):
+                raise MediaRefused("%s is %s, not an image"
+                                   % (url, content_type))
+            data = response.read(self.max_file_bytes + 1)
+        finally:
+            response.close()
+        if len(data) > self.max_file_bytes:
+            raise MediaRefused("%s is larger than %d bytes"
+                               % (url, self.max_file_bytes))
+        return data
+
+    def store(self, path, data):
+        with atomic_write(path) as f:
+            f.write(data)
+        self.evict()
+
+    def link(self, source, path):
+        """Stores a cached file under a second name too."""
+        fd, temp = self.temp_file()
+        os.close(fd)
+        os.remove(temp)
+        try:
+            os.link(source, temp)
+        except OSError:
+            shutil.copyfile(source, temp)
+        os.rename(temp, path)
+        self.evict()
+
+    def temp_file(self):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        return tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes least recently used files until under max_bytes."""
+        with self._lock:
+            files = []
+            for name in os.listdir(self.folder):
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(self.folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for mtime, size, path in files)
+            for mtime, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                self.remove(path)
+                total -= size
+
+
+media_cache = MediaCache(
+    app.config.get('MEDIA_CACHE_DIR',
+                   os.path.join(app.root_path, '..', 'media_cache')),
+    max_bytes=app.config.get('MEDIA_CACHE_MAX_BYTES', 200 * 1024 * 1024),
+    max_file_bytes=app.config.get('MEDIA_MAX_FILE_BYTES', 10 * 1024 * 1024),
+    timeout=app.config.get('MEDIA_FETCH_TIMEOUT', 10))
+
+
+def theme_background(theme, width=None):
+    """Returns the URL to use for a theme's background image."""
+    if (not app.config.get('MEDIA_CACHE_ENABLED', True) or
+            urlparse(theme.theme_path).scheme not in ('http', 'https')):
+        return theme.theme_path
+    # The version changes with the path, so browsers don't keep showing an
+    # old background after the theme is edited.
+    version = hashlib.sha1(theme.theme_path.encode('utf-8')).hexdigest()[:8]
+    return url_for('theme_media', theme_id=theme.id, w=width, v=version)
+
+
+@app.context_processor
+def media_helpers():
+    return dict(theme_background=theme_background,
+                background_widths=BACKGROUND_WIDTHS)
+
+
+@app.route("/media/theme/<int:theme_id>")
+def theme_media(theme_id):
+    """Serves a theme's background image from the local media cache.
+
+    Anything but an image from a public address is a 404, so this never
+    serves other content from our origin, and media that can't be fetched
+    is a 502. It never redirects to the theme's own URL, which anyone
+    owning a theme could point anywhere.
+    """
+    theme = Theme.query.get(theme_id)
+    if not theme or not theme.theme_path:
+        abort(404)
+    if urlparse(theme.theme_path).scheme not in ('http', 'https'):
+        abort(404)
+
+    width = request.args.get('w', type=int)
+    if width not in BACKGROUND_WIDTHS:
+        width = None
+    try:
+        path = media_cache.get(theme.theme_path, width)
+    except MediaRefused:
+        app.logger.warning("Refused to serve %s", theme.theme_path,
+                           exc_info=True)
+        abort(404)
+    except (IOError, ValueError):
+        app.logger.warning("Could not cache %s", theme.theme_path,
+                           exc_info=True)
+        abort(502)
+
+    kind = imghdr.what(path)
+    response = send_file(path, mimetype='image/%s' % kind if kind else None)
+    response.cache_control.public = True
+    response.cache_control.max_age = ONE_DAY
+    return response
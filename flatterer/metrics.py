@@ -0,0 +1,436 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import shutil
+import tempfile
+from glob import glob
+from collections import defaultdict, OrderedDict
+from threading import Lock
+
+from flask import g, request, has_request_context, Response, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.security import safe_str_cmp
+from werkzeug.wsgi import ClosingIterator
+
+from flatterer import app, db
+from cache import (compliment_pool, personal_pool, page_cache, user_cache,
+                   complimentee_cache)
+from spool import compliment_spool, process_alive
+from events import event_hub
+from util import atomic_write, ProcessThread
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Histogram(object):
+    """Prometheus style histogram with one series per label value."""
+
+    def __init__(self, name, help, buckets, label):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [
+                    [0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def families(self):
+        samples = []
+        with self._lock:
+            for label_value, (counts, total, count) in sorted(
+                    self._series.items()):
+                label = '%s="%s"' % (self.label, label_value)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append(('_bucket', '{%s,le="%s"}'
+                                    % (label, bound), bucket_count))
+                samples.append(('_bucket', '{%s,le="+Inf"}' % label, count))
+                samples.append(('_sum', '{%s}' % label, total))
+                samples.append(('_count', '{%s}' % label, count))
+        return [(self.name, 'histogram', self.help, samples)]
+
+
+class Metrics(object):
+    """Request, SQL and cache metrics for the app."""
+
+    def __init__(self):
+        self.request_latency = Histogram(
+            'flatterer_request_duration_seconds',
+            'Time spent handling requests.', LATENCY_BUCKETS, 'endpoint')
+        self.request_queries = Histogram(
+            'flatterer_request_queries',
+            'SQL queries issued per request.', QUERY_COUNT_BUCKETS,
+            'endpoint')
+        self.query_latency = Histogram(
+            'flatterer_query_duration_seconds',
+            'Time spent in SQL queries.', LATENCY_BUCKETS, 'endpoint')
+        self.responses = defaultdict(int)
+        self.in_flight = 0
+        self.slow_queries = 0
+        self._lock = Lock()
+
+    def start_request(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finish_request(self, endpoint, status, duration=None):
+        with self._lock:
+            self.in_flight -= 1
+            self.responses[(endpoint, status)] += 1
+        if duration is not None:
+            self.request_latency.observe(endpoint, duration)
+
+    def record_slow_query(self, endpoint, duration, statement):
+        with self._lock:
+            self.slow_queries += 1
+        app.logger.warning("Slow query (%.3fs) on %s: %s", duration,
+                           endpoint, statement)
+
+    def families(self):
+        """Returns all metrics as (name, type, help, samples) families.
+
+        Each sample is (name suffix, labels, value).
+        """
+        families = []
+        for histogram in (self.request_latency, self.request_queries,
+                          self.query_latency):
+            families.extend(histogram.families())
+
+        with self._lock:
+            families.append((
+                'flatterer_responses_total', 'counter', 'Responses sent.',
+                [('', '{endpoint="%s",status="%s"}' % key, count)
+                 for key, count in sorted(self.responses.items())]))
+            families.append(gauge('flatterer_requests_in_flight',
+                                  'Requests being handled.', self.in_flight))
+        families.append(counter('flatterer_slow_queries_total', 'Queries '
+                                'slower than SLOW_QUERY_THRESHOLD.',
+                                self.slow_queries))
+
+        families.extend(pool_metrics())
+        families.extend(cache_metrics())
+        families.extend(spool_metrics())
+        families.extend(event_metrics())
+        return families
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        return render_families(self.families())
+
+
+def gauge(name, help, value, labels=''):
+    return (name, 'gauge', help, [('', labels, value)])
+
+
+def counter(name, help, value, labels=''):
+    return (name, 'counter', help, [('', labels, value)])
+
+
+def render_families(families):
+    lines = []
+    for name, type, help, samples in families:
+        lines.extend(['# HELP %s %s' % (name, help),
+                      '# TYPE %s %s' % (name, type)])
+        for suffix, labels, value in samples:
+            lines.append('%s%s%s %s' % (name, suffix, labels,
+                                        format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    if isinstance(value, (int, long)):
+        return '%d' % value
+    return '%f' % value
+
+
+def merge_families(*groups):
+    """Adds up the samples of several processes' families."""
+    merged = OrderedDict()
+    for families in groups:
+        for name, type, help, samples in families:
+            if name not in merged:
+                merged[name] = (type, help, OrderedDict())
+            values = merged[name][2]
+            for suffix, labels, value in samples:
+                key = (suffix, labels)
+                values[key] = values.get(key, 0) + value
+    result = []
+    for name, (type, help, values) in merged.items():
+        result.append((name, type, help, [sample + (total,) for
+                                          sample, total in values.items()]))
+    return result
+
+
+def pool_metrics():
+    """Returns connection pool gauges, for pools that keep counts."""
+    pool = db.engine.pool
+    return [gauge('flatterer_db_pool_%s' % stat,
+                  'Connection pool %s.' % stat, getattr(pool, stat)())
+            for stat in ('size', 'checkedin', 'checkedout', 'overflow')
+            if hasattr(pool, stat)]
+
+
+def cache_metrics():
+    """Returns hit and miss counters for the in-process caches."""
+    samples = []
+    for name, cache in (('compliment_pool', compliment_pool),
+                        ('personal_pool', personal_pool),
+                        ('page_cache', page_cache),
+                        ('user_cache', user_cache),
+                        ('complimentee_cache', complimentee_cache)):
+        stats = cache.stats()
+        for result in ('hits', 'misses'):
+            samples.append(('', '{cache="%s",result="%s"}'
+                            % (name, result), stats[result]))
+    return [('flatterer_cache_requests_total', 'counter', 'Cache lookups.',
+             samples)]
+
+
+def spool_metrics():
+    """Returns the write-behind compliment spool's depth and counters."""
+    return [gauge('flatterer_spool_pending', 'Compliments waiting to be '
+                  'written.', compliment_spool.size()),
+            counter('flatterer_spool_flushed_total',
+                    'Spooled compliments written.', compliment_spool.flushed),
+            counter('flatterer_spool_rejected_total',
+                    'Submissions refused by a full spool.',
+                    compliment_spool.rejected)]
+
+
+def event_metrics():
+    """Returns the event hub's viewer gauges and counters."""
+    stats = event_hub.stats()
+    return [gauge('flatterer_event_viewers', 'Connected event stream '
+                  'viewers.', stats['connections']),
+            counter('flatterer_events_published_total', 'Events published.',
+                    stats['published']),
+            counter('flatterer_events_refused_total',
+                    'Viewers refused by a full hub.', stats['refused'])]
+
+
+class MetricsFiles(ProcessThread):
+    """Metrics files of every process serving the app.
+
+    Each process writes its families to metrics-<pid>.json in `folder`
+    every `interval` seconds, so any worker can answer /metrics for all of
+    them. Counters and histograms are added up over every process,
+    including exited ones, whose files are folded into one archive;
+    gauges only over the processes still running.
+    """
+    ARCHIVE = 'metrics-archive.json'
+
+    def __init__(self, folder, interval=5.0):
+        self.folder = folder
+        self.interval = interval
+        self._lock = Lock()
+
+    def path(self, pid):
+        return os.path.join(self.folder, 'metrics-%d.json' % pid)
+
+    def start(self, metrics):
+        """Starts writing `metrics`, again in a forked worker."""
+        with self._lock:
+            ProcessThread.start(self, metrics)
+
+    def run(self, metrics):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write(metrics.families())
+            except Exception:
+                app.logger.exception("Could not write metrics")
+
+    def close(self, metrics):
+        """Writes this process's final metrics, e.g. as a worker exits."""
+        if self.running_here():
+            self.write(metrics.families())
+
+    def write(self, families, path=None):
+        with atomic_write(path or self.path(os.getpid()), 'w') as f:
+            json.dump(families, f)
+
+    def read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return []
+
+    def collect(self, families):
+        """Returns `families`, this process's, merged with the others'."""
+        with open(os.path.join(self.folder, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.folder, self.ARCHIVE)
+            archive = self.read(archive_path)
+            live = []
+            exited = []
+            for path in glob(os.path.join(self.folder, 'metrics-*.json')):
+                try:
+                    pid = int(os.path.basename(path)[8:-5])
+                except ValueError:
+                    continue
+                if pid == os.getpid():
+                    continue
+                if process_alive(pid):
+                    live.append(self.read(path))
+                else:
+                    exited.append(path)
+            if exited:
+                archive = merge_families(archive, *[
+                    without_gauges(self.read(path)) for path in exited])
+                self.write(archive, archive_path)
+                for path in exited:
+                    os.remove(path)
+        return merge_families(families, archive, *live)
+
+
+def without_gauges(families):
+    return [family for family in families if family[1] != 'gauge']
+
+
+def metrics_folder():
+    """Returns METRICS_DIR, or a temporary folder for this server's run.
+
+    The temporary folder is made before `manage.py serve` forks, so its
+    workers share it, and removed when the process that made it exits.
+    """
+    folder = app.config.get('METRICS_DIR')
+    if folder:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        return folder
+    folder = tempfile.mkdtemp(prefix='flatterer-metrics-')
+    owner = os.getpid()
+    atexit.register(lambda: os.getpid() == owner and
+                    shutil.rmtree(folder, ignore_errors=True))
+    return folder
+
+
+class MetricsMiddleware(object):
+    """WSGI middleware timing every request and counting its status.
+
+    A request is recorded once its body has been sent, when the server
+    closes the response, so streamed pages count in full.
+    """
+
+    def __init__(self, wsgi_app, metrics):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        status = []
+
+        def record_status(status_line, headers, exc_info=None):
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        def finish():
+            self.metrics.finish_request(
+                environ.get('flatterer.endpoint') or 'none',
+                status[0] if status else '500', time.time() - start)
+
+        self.metrics.start_request()
+        start = time.time()
+        try:
+            app_iter = self.wsgi_app(environ, record_status)
+        except:
+            finish()
+            raise
+        if environ.get('flatterer.stream'):
+            # Event streams stay open for as long as someone watches, so
+            # they count as responses but not as requests in flight or in
+            # the latency histogram.
+            self.metrics.finish_request(
+                environ.get('flatterer.endpoint') or 'none',
+                status[0] if status else '200')
+            return app_iter
+        return ClosingIterator(app_iter, finish)
+
+
+metrics = Metrics()
+app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics)
+metrics_files = MetricsFiles(metrics_folder(),
+                             app.config.get('METRICS_WRITE_INTERVAL', 5.0))
+
+
+@app.before_request
+def start_query_count():
+    metrics_files.start(metrics)
+    request.environ['flatterer.endpoint'] = request.endpoint
+    # Queries from Flask-Login's user loader may already be counted.
+    g.query_count = getattr(g, 'query_count', 0)
+
+
+@app.teardown_request
+def record_query_count(exc=None):
+    if hasattr(g, 'query_count'):
+        metrics.request_queries.observe(request.endpoint or 'none',
+                                        g.query_count)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'dbapi_error')
+def drop_query_timer(conn, cursor, statement, parameters, context,
+                     exception):
+    # Failed queries never reach after_cursor_execute.
+    if conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info['query_start'].pop()
+    endpoint = 'none'
+    if has_request_context():
+        endpoint = request.endpoint or 'none'
+        g.query_count = getattr(g, 'query_count', 0) + 1
+    metrics.query_latency.observe(endpoint, duration)
+
+    threshold = app.config.get('SLOW_QUERY_THRESHOLD')
+    if threshold is not None and duration >= threshold:
+        metrics.record_slow_query(endpoint, duration, statement)
+
+
+def metrics_allowed():
+    """Tells whether the request may read /metrics.
+
+    It must come from one of METRICS_ALLOWED_IPS or carry METRICS_TOKEN
+    as a bearer token.
+    """
+    if request.remote_addr in app.config.get('METRICS_ALLOWED_IPS',
+                                             ('127.0.0.1', '::1')):
+        return True
+    token = app.config.get('METRICS_TOKEN')
+    scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+    return bool(token and scheme.lower() == 'bearer' and
+                safe_str_cmp(given.strip(), token))
+
+
+@app.route("/metrics")
+def metrics_page():
+    """Exposes the metrics of every worker in the Prometheus text format."""
+    if not metrics_allowed():
+        abort(403)
+    return Response(
+        render_families(metrics_files.collect(metrics.families())),
+        mimetype='text/plain; version=0.0.4')
@@ -1,8 +1,11 @@
+import re
+import hashlib
 from datetime import datetime, date, time, timedelta
 
 from flatterer import db
 
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, DDL
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -44,7 +47,7 @@ class Complimentee(db.Model):
     name = db.Column(db.String(50), unique=True)  # Change unique to false
     url = db.Column(db.String(50), unique=True)
     greeting = db.Column(db.String(1000))
-    owner = db.Column(db.Integer)  # Id for user
+    owner = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
 
     def __init__(self, name, url, owner, greeting=None):
         self.name = name
@@ -57,17 +60,41 @@ class Theme(db.Model):
     """Describes special elements for pages generated for individuals."""
     __tablename__ = "themes"
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('complimentee.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('complimentee.id'),
+                        index=True)
     # Can be local file paths or urls
     theme_path = db.Column(db.String(255))
     song_path = db.Column(db.String(255))
+    # Worked out from song_path when it is set, see set_paths.
+    song_embed_path = db.Column(db.String(255))
+    media_kind = db.Column(db.String(20))
 
     complimentee = db.relationship('Complimentee', backref='theme')
 
     def __init__(self, user_id, theme_path=None, song_path=None):
         self.user_id = user_id
-        self.theme_path = theme_path
-        self.song_path = song_path
+        self.set_paths(theme_path, song_path)
+
+    def set_paths(self, theme_path, song_path):
+        """Sets the theme's paths and the song's media kind and embed path."""
+        for name, value in self.path_values(theme_path, song_path).items():
+            setattr(self, name, value)
+
+    @staticmethod
+    def path_values(theme_path, song_path):
+        """Returns the column values set_paths sets, for use in bulk."""
+        media_kind, song_embed_path = song_media(song_path)
+        return dict(theme_path=theme_path, song_path=song_path,
+                    media_kind=media_kind, song_embed_path=song_embed_path)
+
+
+def song_media(song_path):
+    """Returns the media kind and embeddable path for a song path."""
+    if not song_path:
+        return None, None
+    if "youtube" in song_path:
+        return 'youtube', song_path.replace("watch?v=", "embed/")
+    return 'audio', song_path
 
 
 class Gender(db.Model):
@@ -91,6 +118,8 @@ class Compliment(db.Model):
     gender = db.Column(db.String(50), db.ForeignKey('gender.gender'))
     user_id = db.Column(db.Integer, db.ForeignKey('complimentee.id'))
     approved = db.Column(db.Boolean)
+    # Hash of the normalized text, for spotting duplicates.
+    text_hash = db.Column(db.String(40))
     user = db.relationship("Complimentee", backref=db.backref("compliments"))
 
     def __init__(self, compliment, gender=None, user_id=None, approved=False):
@@ -98,6 +127,74 @@ class Compliment(db.Model):
         self.gender = gender
         self.user_id = user_id
         self.approved = approved
+        self.text_hash = text_hash(compliment)
 
     def __repr__(self):
         return "<Compliment('%s')>" % (self.compliment)
+
+
+class ComplimenteeViews(db.Model):
+    """Counts views of a complimentee's page per time bucket."""
+    __tablename__ = 'complimentee_views'
+    complimentee_id = db.Column(db.Integer, db.ForeignKey('complimentee.id'),
+                                primary_key=True)
+    # Unix time at the start of the bucket.
+    bucket = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    views = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, complimentee_id, bucket, views=0):
+        self.complimentee_id = complimentee_id
+        self.bucket = bucket
+        self.views = views
+
+
+class IdempotencyKey(db.Model):
+    """The stored response to a request sent with an Idempotency-Key."""
+    __tablename__ = 'idempotency_keys'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                        primary_key=True)
+    key = db.Column(db.String(100), primary_key=True)
+    # Hash of the request body, so a key can't be reused for another one.
+    fingerprint = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.Integer, nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__(self, user_id, key, fingerprint, status, response):
+        self.user_id = user_id
+        self.key = key
+        self.fingerprint = fingerprint
+        self.status = status
+        self.response = response
+        self.created_at = datetime.utcnow()
+
+
+def text_hash(compliment):
+    """Hashes a compliment ignoring case, punctuation and spacing."""
+    words = re.findall(r'\w+', (compliment or u'').lower(), re.UNICODE)
+    return hashlib.sha1(u' '.join(words).encode('utf-8')).hexdigest()
+
+
+# Serves the approved-by-gender pool query and gender-only lookups. The
+# compliment text is left out of the key, which InnoDB can't index whole.
+db.Index('ix_compliments_gender_approved', Compliment.gender,
+         Compliment.approved, Compliment.id)
+# Serves the unapproved moderation queue.
+db.Index('ix_compliments_approved_gender', Compliment.approved,
+         Compliment.gender)
+# Serves the personal compliment query for a complimentee.
+db.Index('ix_compliments_user_id', Compliment.user_id, Compliment.id)
+# Serves duplicate checks, which look compliments up by hash within a
+# complimentee (or among the gendered ones), and stops two submissions of
+# the same personal compliment that both passed the check.
+db.Index('ux_compliments_text_hash', Compliment.text_hash, Compliment.user_id,
+         unique=True)
+# Gendered compliments have no user_id, and NULLs never clash in a unique
+# index, so they get a partial index of their own. MySQL has none; there
+# only the duplicate check guards them. Autogenerate skips it, see
+# migrations/env.py.
+GENDERED_TEXT_HASH = ("CREATE UNIQUE INDEX ux_compliments_gendered_text_hash "
+                      "ON compliments (text_hash) WHERE user_id IS NULL")
+event.listen(Compliment.__table__, 'after_create',
+             DDL(GENDERED_TEXT_HASH).execute_if(
+                 dialect=('sqlite', 'postgresql')))
@@ -0,0 +1,243 @@
+import json
+import hashlib
+from datetime import datetime, timedelta
+
+from flask import request, g
+from flask.ext.login import login_required
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from flatterer import app, db
+from models import (Complimentee, Theme, Compliment, IdempotencyKey,
+                    text_hash)
+from cache import personal_pool
+from forms import url_problem
+from publish import publish_scheduler
+
+complimentees = Complimentee.__table__
+themes = Theme.__table__
+compliments = Compliment.__table__
+
+
+def text_value(value, label, limit, errors, required=False):
+    """Returns a stripped string field, or None, adding any errors."""
+    if value is None or value == '':
+        if required:
+            errors.append("%s is required." % label)
+        return None
+    if not isinstance(value, basestring):
+        errors.append("%s must be a string." % label)
+        return None
+    value = value.strip()
+    if required and not value:
+        errors.append("%s is required." % label)
+    elif limit and len(value) > limit:
+        errors.append("%s is longer than %d characters." % (label, limit))
+    return value or None
+
+
+def clean_item(item):
+    """Validates one complimentee of a batch; returns (fields, errors)."""
+    if not isinstance(item, dict):
+        return {}, ["Each complimentee must be an object."]
+    errors = []
+    fields = {}
+    for name, required in (('name', True), ('url', True),
+                           ('greeting', False)):
+        fields[name] = text_value(item.get(name), name,
+                                  complimentees.c[name].type.length,
+                                  errors, required)
+    if fields['url'] and url_problem(fields['url']):
+        errors.append(url_problem(fields['url']))
+
+    theme = item.get('theme')
+    fields['theme'] = None
+    if isinstance(theme, dict):
+        paths = [text_value(theme.get(name), 'theme.' + name,
+                            themes.c[name].type.length, errors)
+                 for name in ('theme_path', 'song_path')]
+        if any(paths):
+            fields['theme'] = paths
+    elif theme is not None:
+        errors.append("theme must be an object.")
+
+    fields['compliments'] = []
+    texts = item.get('compliments') or []
+    if isinstance(texts, list):
+        for text in texts:
+            text = text_value(text, 'compliment',
+                              compliments.c.compliment.type.length,
+                              errors, required=True)
+            if text:
+                fields['compliments'].append(text)
+    else:
+        errors.append("compliments must be a list.")
+    return fields, errors
+
+
+def onboard(owner, items):
+    """Creates a batch of complimentees with their themes and compliments.
+
+    Taken urls and names are looked up for the whole batch in one query,
+    and each table gets a single multi-row INSERT. Items that are invalid
+    or taken are reported and skipped. Returns a result per item; the
+    caller commits.
+    """
+    cleaned = [clean_item(item) for item in items]
+    urls = set(fields['url'] for fields, errors in cleaned if not errors)
+    names = set(fields['name'] for fields, errors in cleaned if not errors)
+    taken_urls, taken_names = set(), set()
+    if urls:
+        for url, name in db.session.execute(
+                complimentees.select()
+                .with_only_columns([complimentees.c.url,
+                                    complimentees.c.name])
+                .where(or_(complimentees.c.url.in_(urls),
+                           complimentees.c.name.in_(names)))):
+            taken_urls.add(url)
+            taken_names.add(name)
+
+    results, created = [], []
+    for index, (fields, errors) in enumerate(cleaned):
+        result = {'index': index, 'url': fields.get('url')}
+        results.append(result)
+        if not errors:
+            if fields['url'] in taken_urls:
+                errors.append("This url is already taken!")
+            if fields['name'] in taken_names:
+                errors.append("This name is already taken!")
+        if errors:
+            result.update(status='error', errors=errors)
+            continue
+        # Later items can't take what an earlier one in the batch has.
+        taken_urls.add(fields['url'])
+        taken_names.add(fields['name'])
+        result['status'] = 'created'
+        created.append((result, fields))
+    if not created:
+        return results
+
+    new = [pair[1] for pair in created]
+    db.session.execute(complimentees.insert(), [
+        dict(name=item['name'], url=item['url'],
+             greeting=item['greeting'], owner=owner)
+        for item in new])
+    ids = dict(db.session.execute(
+        complimentees.select()
+        .with_only_columns([complimentees.c.url, complimentees.c.id])
+        .where(complimentees.c.url.in_([item['url'] for item in new])))
+        .fetchall())
+
+    theme_rows, compliment_rows = [], []
+    for result, fields in created:
+        result['id'] = ids[fields['url']]
+        if fields['theme']:
+            theme_rows.append(dict(Theme.path_values(*fields['theme']),
+                                   user_id=result['id']))
+        # Repeats within an item are added once, as in add_compliment.
+        hashes = set()
+        for text in fields['compliments']:
+            hashed = text_hash(text)
+            if hashed not in hashes:
+                hashes.add(hashed)
+                compliment_rows.append(dict(compliment=text,
+                                            user_id=result['id'],
+                                            approved=True,
+                                            text_hash=hashed))
+        result['compliments'] = len(hashes)
+    if theme_rows:
+        db.session.execute(themes.insert(), theme_rows)
+    if compliment_rows:
+        db.session.execute(compliments.insert(), compliment_rows)
+    return results
+
+
+def json_response(body, status=200):
+    if not isinstance(body, basestring):
+        body = json.dumps(body)
+    return app.response_class(body, status, mimetype='application/json')
+
+
+def key_cutoff():
+    """Returns the time before which stored responses have expired."""
+    return datetime.utcnow() - timedelta(
+        seconds=app.config.get('IDEMPOTENCY_KEY_TTL', 24 * 3600))
+
+
+def stored_response(user_id, key, fingerprint):
+    """Returns the response saved for an idempotency key, if any."""
+    stored = (IdempotencyKey.query
+              .filter_by(user_id=user_id, key=key)
+              .filter(IdempotencyKey.created_at >= key_cutoff())
+              .first())
+    if not stored:
+        return None
+    if stored.fingerprint != fingerprint:
+        return json_response({'error': "This Idempotency-Key was used "
+                                       "for a different request."}, 422)
+    response = json_response(stored.response, stored.status)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+@app.route("/api/complimentees", methods=['POST'])
+@login_required
+def onboard_complimentees():
+    """Creates complimentees in bulk from a JSON list.
+
+    Each item has a name, url and optional greeting, theme (theme_path,
+    song_path) and list of compliments. Everything is written in one
+    transaction and the response has a result per item. With an
+    Idempotency-Key header, retries get the first response back.
+    """
+    items = request.get_json(silent=True)
+    if isinstance(items, dict):
+        items = items.get('complimentees')
+    if not isinstance(items, list):
+        return json_response({'error': "Send a JSON list of "
+                                       "complimentees."}, 400)
+    limit = app.config.get('ONBOARDING_MAX_BATCH', 100)
+    if len(items) > limit:
+        return json_response({'error': "At most %d complimentees can be "
+                                       "sent at once." % limit}, 413)
+
+    key = request.headers.get('Idempotency-Key')
+    fingerprint = hashlib.sha1(request.get_data()).hexdigest()
+    if key:
+        if len(key) > IdempotencyKey.__table__.c.key.type.length:
+            return json_response({'error': "Idempotency-Key is too "
+                                           "long."}, 400)
+        replay = stored_response(g.user.id, key, fingerprint)
+        if replay:
+            return replay
+
+    results = onboard(g.user.id, items)
+    created = [result for result in results if result['status'] == 'created']
+    body = json.dumps({'created': len(created),
+                       'failed': len(results) - len(created),
+                       'results': results})
+    if key:
+        # Saved in the same transaction, so a retry either finds this
+        # response or finds nothing was written.
+        (IdempotencyKey.query
+         .filter_by(user_id=g.user.id)
+         .filter(IdempotencyKey.created_at < key_cutoff())
+         .delete(synchronize_session=False))
+        db.session.add(IdempotencyKey(g.user.id, key, fingerprint, 200,
+                                      body))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent request took one of the urls or names, or sent the
+        # same key and got there first.
+        db.session.rollback()
+        replay = key and stored_response(g.user.id, key, fingerprint)
+        return replay or json_response(
+            {'error': "Another request created some of these "
+                      "complimentees at the same time; try again."}, 409)
+
+    for result in created:
+        personal_pool.invalidate(result['id'])
+    if created:
+        publish_scheduler.schedule(result['id'] for result in created)
+    return json_response(body)
@@ -0,0 +1,248 @@
+import os
+import json
+import fcntl
+import random
+import hashlib
+import multiprocessing
+from collections import defaultdict
+from threading import Lock
+
+from flask import render_template
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+from flatterer import app, db, login_manager
+from models import Complimentee, Compliment
+from forms import LoginForm, url_problem
+from jobs import BackgroundJob
+from util import atomic_write
+
+MANIFEST = '.published.json'
+LOCK = '.publish.lock'
+
+
+def publish_folder():
+    return app.config.get('PUBLISH_DIR')
+
+
+def page_paths(folder, url):
+    """Returns the HTML page and JSON sidecar paths for a complimentee.
+
+    Raises ValueError for a url that would put them anywhere but directly
+    in the folder's compliment/ directory.
+    """
+    pages = os.path.realpath(os.path.join(folder, 'compliment'))
+    base = os.path.realpath(os.path.join(pages, url))
+    if os.path.dirname(base) != pages or url_problem(url):
+        raise ValueError("Refusing to publish %r outside %s"
+                         % (url, pages))
+    return base + '.html', base + '.json'
+
+
+def signatures(complimentee_ids=None):
+    """Returns {url: (complimentee id, signature)} for complimentees.
+
+    That is every complimentee, or only those in `complimentee_ids`. The
+    signature changes whenever the complimentee, their theme or their set
+    of compliments does.
+    """
+    stats = (db.session.query(Compliment.user_id,
+                              func.count(Compliment.id),
+                              func.max(Compliment.id),
+                              func.sum(Compliment.id))
+             .filter(Compliment.user_id != None)
+             .group_by(Compliment.user_id))
+    complimentees = Complimentee.query.options(
+        joinedload(Complimentee.theme))
+    if complimentee_ids is not None:
+        stats = stats.filter(Compliment.user_id.in_(complimentee_ids))
+        complimentees = complimentees.filter(
+            Complimentee.id.in_(complimentee_ids))
+    stats = dict((user_id, (count, max_id, int(id_sum))) for
+                 user_id, count, max_id, id_sum in stats)
+    result = {}
+    for complimentee in complimentees:
+        theme = complimentee.theme[0] if complimentee.theme else None
+        parts = [complimentee.name, complimentee.greeting,
+                 theme and theme.theme_path, theme and theme.song_path,
+                 stats.get(complimentee.id)]
+        signature = hashlib.sha1(json.dumps(parts)).hexdigest()
+        result[complimentee.url] = (complimentee.id, signature)
+    return result
+
+
+def render_page(complimentee, compliments):
+    """Renders a complimentee's page and JSON sidecar as seen anonymously.
+
+    The page reads its compliments from the sidecar instead of the feed,
+    so serving it needs nothing but a static file server.
+    """
+    prefix = app.config.get('PUBLISH_URL_PREFIX', '/compliment')
+    theme = complimentee.theme[0] if complimentee.theme else None
+    compliments = [{'id': id, 'compliment': compliment}
+                   for id, compliment in compliments]
+    random.shuffle(compliments)
+    sidecar = {'url': complimentee.url, 'name': complimentee.name,
+               'greeting': complimentee.greeting,
+               'theme': theme and {'theme_path': theme.theme_path,
+                                   'song_path': theme.song_path,
+                                   'media_kind': theme.media_kind},
+               'compliments': compliments}
+    with app.test_request_context('/compliment/' + complimentee.url):
+        page = render_template(
+            "compliment_individual.html",
+            user=login_manager.anonymous_user(),
+            login_form=LoginForm(csrf_enabled=False),
+            greeting=complimentee.greeting, name=complimentee.name,
+            theme=theme,
+            feed_url='%s/%s.json' % (prefix, complimentee.url))
+    return page, sidecar
+
+
+def remove_page(folder, url):
+    try:
+        paths = page_paths(folder, url)
+    except ValueError:
+        return
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def publish_ids(complimentee_ids, folder=None):
+    """Renders the pages of some complimentees; returns their count.
+
+    Complimentees without compliments have no page, as in the app.
+    """
+    folder = folder or publish_folder()
+    compliments = defaultdict(list)
+    for user_id, id, compliment in (
+            db.session.query(Compliment.user_id, Compliment.id,
+                             Compliment.compliment)
+            .filter(Compliment.user_id.in_(complimentee_ids))):
+        compliments[user_id].append((id, compliment))
+    complimentees = (Complimentee.query
+                     .options(joinedload(Complimentee.theme))
+                     .filter(Complimentee.id.in_(complimentee_ids))
+                     .all())
+    db.session.remove()
+
+    published = 0
+    for complimentee in complimentees:
+        if not compliments[complimentee.id]:
+            remove_page(folder, complimentee.url)
+            continue
+        try:
+            html_path, json_path = page_paths(folder, complimentee.url)
+        except ValueError:
+            app.logger.warning("Not publishing %r", complimentee.url,
+                               exc_info=True)
+            continue
+        page, sidecar = render_page(complimentee,
+                                    compliments[complimentee.id])
+        with atomic_write(json_path) as f:
+            json.dump(sidecar, f)
+        with atomic_write(html_path) as f:
+            f.write(page.encode('utf-8'))
+        published += 1
+    return published
+
+
+def init_worker():
+    from server import dispose_engines
+    dispose_engines()
+    db.session.remove()
+    random.seed()
+
+
+def publish(full=False, processes=None, chunk_size=100,
+            complimentee_ids=None):
+    """Publishes the pages that changed since the last publish.
+
+    With `complimentee_ids`, only those complimentees are checked, and
+    pages of deleted complimentees are left for the next publish of
+    everyone. With `full`, every page is rendered again, spread over a
+    pool of `processes` processes (one per CPU by default). Returns the
+    number of pages written and removed.
+    """
+    if full:
+        complimentee_ids = None
+    folder = publish_folder()
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    # One publish at a time, across processes too.
+    with open(os.path.join(folder, LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest_path = os.path.join(folder, MANIFEST)
+        manifest = {}
+        if not full and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        current = signatures(complimentee_ids)
+        db.session.remove()
+        changed = [id for url, (id, signature) in sorted(current.items())
+                   if manifest.get(url) != signature]
+        removed = []
+        if complimentee_ids is None:
+            removed = [url for url in manifest if url not in current]
+
+        chunks = [changed[i:i + chunk_size]
+                  for i in range(0, len(changed), chunk_size)]
+        if full and len(chunks) > 1 and processes != 1:
+            pool = multiprocessing.Pool(processes, initializer=init_worker)
+            try:
+                published = sum(pool.map(publish_ids, chunks))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            published = sum(publish_ids(chunk, folder) for chunk in chunks)
+
+        for url in removed:
+            remove_page(folder, url)
+            del manifest[url]
+        manifest.update((url, signature)
+                        for url, (id, signature) in current.items())
+        with atomic_write(manifest_path) as f:
+            json.dump(manifest, f)
+    return published, len(removed)
+
+
+class PublishScheduler(BackgroundJob):
+    """Runs incremental publishes in the background after edits.
+
+    Edits pass the ids of the complimentees they changed, and only those
+    are checked; an edit that passes none has everyone checked.
+    """
+
+    def __init__(self):
+        BackgroundJob.__init__(self, self.publish_changed, 'publish')
+        self._ids_lock = Lock()
+        self._ids = set()
+        self._everyone = False
+
+    def schedule(self, complimentee_ids=None):
+        if not (publish_folder() and
+                app.config.get('PUBLISH_ON_CHANGE', True)):
+            return
+        with self._ids_lock:
+            if complimentee_ids is None:
+                self._everyone = True
+            else:
+                self._ids.update(complimentee_ids)
+        BackgroundJob.schedule(self)
+
+    def publish_changed(self):
+        with self._ids_lock:
+            ids, everyone = self._ids, self._everyone
+            self._ids, self._everyone = set(), False
+        if everyone:
+            publish()
+        elif ids:
+            publish(complimentee_ids=sorted(ids))
+
+
+publish_scheduler = PublishScheduler()
@@ -0,0 +1,190 @@
+import os
+import mmap
+import math
+import time
+import fcntl
+import struct
+import hashlib
+import tempfile
+from threading import Lock
+from collections import OrderedDict
+
+from flask import request, Response
+
+from flatterer import app
+
+
+def take_token(tokens, updated, capacity, period, now):
+    """Refills a token bucket and takes one token from it if possible.
+
+    Returns (allowed, tokens left, seconds until the bucket is full).
+    """
+    rate = float(capacity) / period
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    allowed = tokens >= 1
+    if allowed:
+        tokens -= 1
+    return allowed, tokens, (capacity - tokens) / rate
+
+
+def retry_after(tokens, capacity, period):
+    """Seconds until a bucket holding `tokens` has a whole token again."""
+    return max(1, int(math.ceil((1 - tokens) * period / float(capacity))))
+
+
+class MemoryStore(object):
+    """Token buckets for this process only.
+
+    Keeps at most `max_keys` buckets, dropping the least recently used
+    first, and forgets buckets once they have refilled.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self._lock = Lock()
+
+    def consume(self, key, capacity, period, now=None):
+        """Takes a token for `key`, returning (allowed, retry_after)."""
+        now = now or time.time()
+        with self._lock:
+            tokens, updated, expires = self.buckets.pop(
+                key, (capacity, now, now))
+            allowed, tokens, full_in = take_token(tokens, updated, capacity,
+                                                  period, now)
+            self.buckets[key] = (tokens, now, now + full_in)
+            while self.buckets and len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            # A full bucket is the same as no bucket.
+            while self.buckets:
+                old_key, bucket = next(self.buckets.iteritems())
+                if bucket[2] > now:
+                    break
+                del self.buckets[old_key]
+        return allowed, 0 if allowed else retry_after(tokens, capacity,
+                                                     period)
+
+
+class MappedStore(object):
+    """Token buckets in a fixed-size table shared between processes.
+
+    Without `path` the table is in an unlinked temporary file, inherited
+    by workers forked after it is created. With `path` it is a file that
+    any process can map. Either way it is locked with fcntl record locks,
+    which the kernel releases if a process dies holding one. Each key
+    hashes to a small run of slots; when all are in use, the bucket
+    closest to being full again is replaced.
+    """
+    SLOT = struct.Struct('<Qddd')  # key hash, tokens, updated, expires
+    PROBES = 8
+
+    def __init__(self, slots=10000, path=None):
+        self.slots = slots
+        size = slots * self.SLOT.size
+        # Record locks are per process, so threads also need this one.
+        self._thread_lock = Lock()
+        if path:
+            folder = os.path.dirname(path)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            self._file = open(path, 'a+b')
+        else:
+            self._file = tempfile.TemporaryFile()
+        if os.fstat(self._file.fileno()).st_size < size:
+            self._file.truncate(size)
+        self.map = mmap.mmap(self._file.fileno(), size)
+
+    def lock(self):
+        self._thread_lock.acquire()
+        try:
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+        except:
+            self._thread_lock.release()
+            raise
+
+    def unlock(self):
+        fcntl.lockf(self._file, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def consume(self, key, capacity, period, now=None):
+        """Takes a token for `key`, returning (allowed, retry_after)."""
+        now = now or time.time()
+        # Zero marks an empty slot.
+        key_hash = struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0] | 1
+        start = key_hash % self.slots
+        self.lock()
+        try:
+            slot, tokens, updated = self.find(key_hash, start)
+            if tokens is None:
+                tokens, updated = capacity, now
+            allowed, tokens, full_in = take_token(tokens, updated, capacity,
+                                                  period, now)
+            self.SLOT.pack_into(self.map, slot * self.SLOT.size, key_hash,
+                                tokens, now, now + full_in)
+        finally:
+            self.unlock()
+        return allowed, 0 if allowed else retry_after(tokens, capacity,
+                                                     period)
+
+    def find(self, key_hash, start):
+        """Returns (slot, tokens, updated) for the key, or a slot to use."""
+        free = None
+        for probe in range(self.PROBES):
+            slot = (start + probe) % self.slots
+            stored_hash, tokens, updated, expires = self.SLOT.unpack_from(
+                self.map, slot * self.SLOT.size)
+            if stored_hash == key_hash:
+                return slot, tokens, updated
+            if free is None or expires < free[1]:
+                free = (slot, expires)
+        return free[0], None, None
+
+
+def create_store(config):
+    backend = config.get('RATE_LIMIT_BACKEND', 'memory')
+    max_keys = config.get('RATE_LIMIT_MAX_KEYS', 10000)
+    if backend == 'shared':
+        return MappedStore(max_keys)
+    if backend == 'file':
+        return MappedStore(max_keys, config['RATE_LIMIT_FILE'])
+    return MemoryStore(max_keys)
+
+
+store = create_store(app.config)
+
+
+def check_rate_limits():
+    """Answers 429 once a client goes over its route's RATE_LIMITS.
+
+    Runs before every other request handler. Buckets keyed by IP address
+    are checked first, without parsing the request body; the username is
+    only read from the form for policies that limit it.
+    """
+    if not app.config.get('RATE_LIMIT_ENABLED', True):
+        return None
+    policy = app.config.get('RATE_LIMITS', {}).get(request.endpoint)
+    if not policy or request.method not in policy.get('methods', ['POST']):
+        return None
+
+    checks = []
+    if 'ip' in policy:
+        checks.append(('ip', request.remote_addr or '', policy['ip']))
+    if 'username' in policy:
+        checks.append(('username', None, policy['username']))
+    for kind, value, (capacity, period) in checks:
+        if value is None:
+            value = request.form.get('username', '').strip().lower()
+            if not value:
+                continue
+        key = '%s:%s:%s' % (request.endpoint, kind, value)
+        allowed, wait = store.consume(key.encode('utf-8'), capacity, period)
+        if not allowed:
+            request.environ['flatterer.endpoint'] = request.endpoint
+            return Response("Too many requests, please try again later.\n",
+                            429, {'Retry-After': str(wait)},
+                            mimetype='text/plain')
+    return None
+
+
+# Ahead of the other handlers, so a limited request loads no user either.
+app.before_request_funcs.setdefault(None, []).insert(0, check_rate_limits)
@@ -0,0 +1,113 @@
+from sqlalchemy import event, DDL, func, literal_column
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import table, column
+
+from flatterer import db
+from models import Compliment, Complimentee
+
+# SQLite keeps an FTS5 index over compliments.compliment in step with the
+# table through triggers, so every insert, edit and delete (bulk ones
+# included) is reflected without the app doing anything.
+SQLITE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE compliments_fts USING fts5("
+    "compliment, content='compliments', content_rowid='id')",
+    "CREATE TRIGGER compliments_fts_insert AFTER INSERT ON compliments BEGIN "
+    "INSERT INTO compliments_fts(rowid, compliment) "
+    "VALUES (new.id, new.compliment); END",
+    "CREATE TRIGGER compliments_fts_delete AFTER DELETE ON compliments BEGIN "
+    "INSERT INTO compliments_fts(compliments_fts, rowid, compliment) "
+    "VALUES ('delete', old.id, old.compliment); END",
+    "CREATE TRIGGER compliments_fts_update AFTER UPDATE OF compliment "
+    "ON compliments BEGIN "
+    "INSERT INTO compliments_fts(compliments_fts, rowid, compliment) "
+    "VALUES ('delete', old.id, old.compliment); "
+    "INSERT INTO compliments_fts(rowid, compliment) "
+    "VALUES (new.id, new.compliment); END",
+]
+compliments_fts = table('compliments_fts', column('rowid'))
+
+# MySQL maintains FULLTEXT indexes itself.
+MYSQL_FTS_DDL = [
+    "CREATE FULLTEXT INDEX ix_compliments_fulltext "
+    "ON compliments (compliment)",
+]
+
+for statement in SQLITE_FTS_DDL:
+    event.listen(Compliment.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+for statement in MYSQL_FTS_DDL:
+    event.listen(Compliment.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='mysql'))
+
+
+def fts_query(terms):
+    """Quotes each search term so FTS5 treats user input as plain words."""
+    return u' '.join(u'"%s"' % term.replace(u'"', u'""')
+                     for term in terms.split())
+
+
+def boolean_query(terms):
+    """Requires each search term as a phrase in a MySQL boolean search.
+
+    Operators such as + - * ~ ( ) and < > are plain text inside a
+    phrase. Quotes can't be escaped there, so they are dropped.
+    """
+    terms = [term.replace(u'"', u'') for term in terms.split()]
+    return u' '.join(u'+"%s"' % term for term in terms if term)
+
+
+def search_compliments(terms, gender=None, approved=None, complimentee=None,
+                       page=1, per_page=25):
+    """Returns a page of compliments matching `terms`, best match first.
+
+    `gender` may be "None" for personal compliments and `complimentee` is
+    a complimentee's url. Returns (compliments, has_next_page).
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        # The table name stands for the whole row in MATCH and bm25().
+        fts_row = literal_column('compliments_fts')
+        query = (db.session.query(Compliment)
+                 .filter(compliments_fts.c.rowid == Compliment.id)
+                 .filter(fts_row.op('MATCH')(fts_query(terms)))
+                 # bm25 scores better matches lower.
+                 .order_by(func.bm25(fts_row)))
+    elif dialect == 'mysql':
+        relevance = Compliment.compliment.match(boolean_query(terms))
+        query = (db.session.query(Compliment)
+                 .filter(relevance)
+                 .order_by(relevance.desc()))
+    else:
+        query = (db.session.query(Compliment)
+                 .filter(Compliment.compliment.contains(terms))
+                 .order_by(Compliment.id))
+
+    if gender == 'None':
+        query = query.filter(Compliment.gender == None)
+    elif gender:
+        query = query.filter(Compliment.gender == gender)
+    if approved is not None:
+        query = query.filter(Compliment.approved == approved)
+    if complimentee:
+        query = query.filter(Compliment.user_id ==
+                             db.session.query(Complimentee.id)
+                             .filter(Complimentee.url == complimentee)
+                             .as_scalar())
+
+    rows = (query.options(joinedload(Compliment.user))
+            .offset((page - 1) * per_page)
+            .limit(per_page + 1).all())
+    return rows[:per_page], len(rows) > per_page
+
+
+def is_duplicate(text_hash, user_id=None):
+    """Checks for a compliment with the same normalized text hash.
+
+    Personal compliments are only compared with others for the same
+    complimentee, gendered ones with other gendered ones. Duplicates
+    submitted at the same time both pass this check; the unique text hash
+    indexes refuse the second, except for gendered ones on MySQL.
+    """
+    return (db.session.query(Compliment.id)
+            .filter_by(text_hash=text_hash, user_id=user_id)
+            .first()) is not None
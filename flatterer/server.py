@@ -0,0 +1,256 @@
+import os
+import time
+import errno
+import random
+import signal
+import Queue
+from threading import Thread, Lock
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from flatterer import app, db
+from spool import compliment_spool
+from analytics import view_counter
+from metrics import metrics, metrics_files
+
+
+class DetachingRequestHandler(WSGIRequestHandler):
+    """Request handler letting the app take over the connection.
+
+    Calling environ['flatterer.detach']() returns the request's socket,
+    which the server then leaves open for the app, e.g. so long-lived
+    event streams don't each hold one of the pool's threads.
+    """
+    # The app writes to a detached socket itself, which only works while
+    # responses are neither chunked nor kept alive. Set on the class so
+    # servers don't switch it to HTTP/1.1.
+    protocol_version = 'HTTP/1.0'
+
+    def make_environ(self):
+        environ = WSGIRequestHandler.make_environ(self)
+        environ['flatterer.detach'] = self.detach
+        return environ
+
+    def detach(self):
+        self.wfile.flush()
+        self.close_connection = True
+        self.server.detach(self.request)
+        return self.request
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server handing requests to a fixed pool of threads.
+
+    Once `max_requests` requests have been handled the server shuts itself
+    down, so its worker process can be replaced with a fresh one.
+    """
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, port, app, threads=4, max_requests=0):
+        BaseWSGIServer.__init__(self, host, port, app,
+                                handler=DetachingRequestHandler)
+        self.threads = threads
+        self.max_requests = max_requests
+        self.handled = 0
+        self._handled_lock = Lock()
+        self._queue = None
+        self._pool = []
+        self._detached = set()
+
+    def start_threads(self):
+        # A bounded queue stops a busy worker accepting more than it can
+        # handle, leaving those connections to the other workers.
+        self._queue = Queue.Queue(self.threads * 2)
+        self._pool = [Thread(target=self.process_queue)
+                      for i in range(self.threads)]
+        for thread in self._pool:
+            thread.daemon = True
+            thread.start()
+
+    def stop_threads(self):
+        """Lets queued requests finish, then stops the threads."""
+        for thread in self._pool:
+            self._queue.put(None)
+        for thread in self._pool:
+            thread.join()
+
+    def process_request(self, request, client_address):
+        request.setblocking(True)
+        self._queue.put((request, client_address))
+
+    def process_queue(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+            self.count_request()
+
+    def detach(self, request):
+        with self._handled_lock:
+            self._detached.add(request)
+
+    def shutdown_request(self, request):
+        with self._handled_lock:
+            detached = request in self._detached
+            self._detached.discard(request)
+        if not detached:
+            BaseWSGIServer.shutdown_request(self, request)
+
+    def count_request(self):
+        with self._handled_lock:
+            self.handled += 1
+            recycle = self.handled == self.max_requests
+        if recycle:
+            self.shutdown_later()
+
+    def shutdown_later(self):
+        """Stops serve_forever without blocking the calling thread."""
+        thread = Thread(target=self.shutdown)
+        thread.daemon = True
+        thread.start()
+
+
+def dispose_engines():
+    """Drops pooled connections inherited from the parent process."""
+    db.engine.dispose()
+    for bind in app.config.get('SQLALCHEMY_BINDS') or ():
+        db.get_engine(app, bind=bind).dispose()
+
+
+class PreforkServer(object):
+    """Forks worker processes that share one listening socket.
+
+    The app is imported once in the master before forking; `warm_up` is
+    called in each worker before it starts accepting. SIGHUP starts a
+    new set of workers and gracefully stops the old ones; SIGTERM or SIGINT
+    stops every worker and then the master. Workers that exit, for example
+    after reaching max_requests, are replaced.
+
+    Each worker has its own database connections and its own copy of the
+    in-memory state, which starts empty again whenever a worker is
+    replaced: the page, user and complimentee caches, the compliment
+    pools (unless COMPLIMENT_SNAPSHOT_PATH is set), 'memory' rate limit
+    buckets, unflushed view counts and spooled compliments, and event
+    stream viewers. Metrics are per worker too but written to METRICS_DIR,
+    and /metrics adds every worker's up.
+    """
+
+    def __init__(self, host, port, wsgi_app, workers=2, threads=4,
+                 max_requests=0, graceful_timeout=30, warm_up=None):
+        self.server = PooledWSGIServer(host, port, wsgi_app, threads,
+                                       max_requests)
+        # Every worker waits on the same socket; only one gets each
+        # connection and the others must not block in accept().
+        self.server.socket.setblocking(False)
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.warm_up = warm_up
+        self.generation = 0
+        self.children = {}
+        self.reloading = False
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        print " * Serving on http://%s:%d with %d workers" % (
+            self.server.server_address[0], self.server.server_address[1],
+            self.workers)
+
+        for i in range(self.workers):
+            self.spawn()
+        while not self.stopping:
+            if self.reloading:
+                self.reload()
+            self.reap()
+            time.sleep(0.5)
+        self.stop()
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = self.generation
+            return
+        try:
+            self.run_worker()
+        finally:
+            os._exit(0)
+
+    def run_worker(self):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: self.server.shutdown_later())
+        dispose_engines()
+        # Otherwise every worker would sample the same "random" compliments.
+        random.seed()
+        if self.warm_up:
+            started = time.time()
+            self.warm_up()
+            print " * Worker %d warmed up in %.1f ms" % (
+                os.getpid(), (time.time() - started) * 1000)
+
+        self.server.start_threads()
+        self.server.serve_forever()
+        self.server.stop_threads()
+        # os._exit skips atexit, so buffered writes are flushed here.
+        compliment_spool.close()
+        view_counter.close()
+        metrics_files.close(metrics)
+
+    def reload(self):
+        """Replaces every worker with a new one."""
+        self.reloading = False
+        old = list(self.children)
+        self.generation += 1
+        for i in range(self.workers):
+            self.spawn()
+        self.kill(old, signal.SIGTERM)
+
+    def reap(self):
+        """Collects exited workers and replaces current generation ones."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            generation = self.children.pop(pid, None)
+            if generation == self.generation and not self.stopping:
+                self.spawn()
+
+    def kill(self, pids, sig):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def stop(self):
+        """Stops the workers, killing any still busy after the timeout."""
+        self.kill(list(self.children), signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.kill(list(self.children), signal.SIGKILL)
+        self.server.server_close()
@@ -0,0 +1,236 @@
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import shutil
+import tempfile
+from array import array
+from threading import Lock
+
+from sqlalchemy import select
+
+from flatterer import app, db
+from models import Compliment
+from cache import PooledCompliment
+from jobs import BackgroundJob
+from util import atomic_write
+
+# Snapshot layout, in native byte order since it never leaves the machine:
+#   header: magic, generation, compliment count, directory length
+#   directory: JSON {"gender": {key: [start, count]}, "user": {...}}
+#   ids: uint32 per compliment
+#   offsets: uint32 per compliment plus one, into the blob
+#   blob: the compliments' UTF-8 text, back to back
+# Each group's compliments are contiguous, so a group is a start index and
+# a count.
+MAGIC = 'FLSNAP01'
+HEADER = struct.Struct('=8sQII')
+UINT = struct.Struct('=I')
+UINT_PAIR = struct.Struct('=II')
+assert array('I').itemsize == UINT.size
+
+
+def snapshot_path():
+    return app.config.get('COMPLIMENT_SNAPSHOT_PATH')
+
+
+def snapshot_queries():
+    """Returns (kind, query) for each kind of group, matching cache.py.
+
+    Each query yields (group key, id, compliment), ordered by group.
+    """
+    table = Compliment.__table__
+    approved = (select([table.c.gender, table.c.id, table.c.compliment])
+                .where(table.c.gender != None)
+                .where(table.c.approved == True)
+                .order_by(table.c.gender, table.c.id))
+    personal = (select([table.c.user_id, table.c.id, table.c.compliment])
+                .where(table.c.user_id != None)
+                .order_by(table.c.user_id, table.c.id))
+    return [('gender', approved), ('user', personal)]
+
+
+def write_snapshot(path=None):
+    """Writes a new snapshot of the compliment pools, replacing the old one.
+
+    The text is streamed to a scratch file, then the whole snapshot is
+    written aside and renamed over the old one, so readers see either
+    snapshot in full. Returns the new generation.
+    """
+    path = path or snapshot_path()
+    folder = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    # Serializes writers, so an older build can't replace a newer one.
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        generation = 1
+        try:
+            with open(path, 'rb') as f:
+                generation = HEADER.unpack(f.read(HEADER.size))[1] + 1
+        except (IOError, struct.error):
+            pass
+
+        ids, offsets = array('I'), array('I', [0])
+        directory = {}
+        with tempfile.TemporaryFile(dir=folder) as blob:
+            # A connection of its own leaves the caller's session alone.
+            connection = db.engine.connect().execution_options(
+                stream_results=True)
+            for kind, query in snapshot_queries():
+                groups = directory[kind] = {}
+                for key, id, compliment in connection.execute(query):
+                    key = unicode(key)
+                    if key not in groups:
+                        groups[key] = [len(ids), 0]
+                    groups[key][1] += 1
+                    # The column is nullable; such rows are kept, empty.
+                    text = (compliment or u'').encode('utf-8')
+                    blob.write(text)
+                    ids.append(id)
+                    offsets.append(offsets[-1] + len(text))
+            connection.close()
+
+            directory = json.dumps(directory)
+            with atomic_write(path, sync=True) as f:
+                f.write(HEADER.pack(MAGIC, generation, len(ids),
+                                    len(directory)))
+                f.write(directory)
+                ids.tofile(f)
+                offsets.tofile(f)
+                blob.seek(0)
+                shutil.copyfileobj(blob, f)
+    return generation
+
+
+class Snapshot(object):
+    """A snapshot file mapped read-only into memory."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, count, directory_size = HEADER.unpack_from(
+            self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a compliment snapshot" % path)
+        self.directory = json.loads(
+            self.map[HEADER.size:HEADER.size + directory_size])
+        self.ids_at = HEADER.size + directory_size
+        self.offsets_at = self.ids_at + count * UINT.size
+        self.blob_at = self.offsets_at + (count + 1) * UINT.size
+
+    def compliment(self, index):
+        id, = UINT.unpack_from(self.map, self.ids_at + index * UINT.size)
+        start, end = UINT_PAIR.unpack_from(
+            self.map, self.offsets_at + index * UINT.size)
+        text = self.map[self.blob_at + start:self.blob_at + end]
+        return PooledCompliment(id, text.decode('utf-8'))
+
+    def group(self, kind, key):
+        start, count = self.directory[kind].get(unicode(key), (0, 0))
+        return SnapshotGroup(self, start, count)
+
+
+class SnapshotGroup(object):
+    """Read-only sequence of one group's compliments in a snapshot.
+
+    Only the compliments that are indexed are decoded.
+    """
+
+    def __init__(self, snapshot, start, count):
+        self.snapshot = snapshot
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.snapshot.compliment(self.start + index)
+
+
+class SnapshotReader(object):
+    """Keeps the newest snapshot mapped.
+
+    At most once every `check_interval` seconds the file is stat'ed; a
+    new inode means a new snapshot was renamed into place. Mappings still
+    in use by other threads stay valid until they are dropped. While there
+    is no file yet, `writer` is scheduled to write one and current()
+    returns None.
+    """
+
+    def __init__(self, writer, check_interval=1.0):
+        self.writer = writer
+        self.check_interval = check_interval
+        self.snapshot = None
+        self.remaps = 0
+        self._checked = 0
+        self._lock = Lock()
+
+    def current(self):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return self.snapshot
+        with self._lock:
+            self._checked = now
+            path = snapshot_path()
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Writing one reads every compliment, too slow for a
+                # request to wait on.
+                self.writer.schedule()
+                return self.snapshot
+            if (not self.snapshot or
+                    (stat.st_ino, stat.st_mtime) !=
+                    (self.snapshot.stat.st_ino, self.snapshot.stat.st_mtime)):
+                self.snapshot = Snapshot(path)
+                self.remaps += 1
+            return self.snapshot
+
+
+class SnapshotPool(object):
+    """Drop-in for ComplimentPool backed by the shared snapshot.
+
+    Invalidating schedules a new snapshot; every process picks it up.
+    Until the first snapshot is written, compliments come from `fallback`,
+    a ComplimentPool loading them from the database.
+    """
+
+    def __init__(self, kind, reader, writer, fallback):
+        self.kind = kind
+        self.reader = reader
+        self.writer = writer
+        self.fallback = fallback
+        self.hits = 0
+
+    def get(self, key):
+        snapshot = self.reader.current()
+        if snapshot is None:
+            return self.fallback.get(key)
+        self.hits += 1
+        return snapshot.group(self.kind, key)
+
+    def invalidate(self, key=None):
+        self.writer.schedule()
+        self.fallback.invalidate(key)
+
+    def stats(self):
+        snapshot = self.reader.snapshot
+        return {'hits': self.hits,
+                'misses': self.reader.remaps,
+                'generation': snapshot.generation if snapshot else None,
+                'fallback': self.fallback.stats()}
+
+
+snapshot_writer = BackgroundJob(write_snapshot, 'snapshot')
+snapshot_reader = SnapshotReader(
+    snapshot_writer, app.config.get('COMPLIMENT_SNAPSHOT_CHECK_INTERVAL', 1.0))
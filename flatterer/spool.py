@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import atexit
+import errno
+from glob import glob
+from threading import Condition
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from flatterer import app, db
+from models import Compliment, text_hash
+from util import ProcessThread
+
+
+class ComplimentSpool(ProcessThread):
+    """Write-behind buffer for unapproved gendered compliments.
+
+    Submissions are queued in memory and, when `folder` is set, appended
+    to a per-process journal so they survive a crash. A background thread
+    inserts them `batch_size` rows per transaction once a batch is full
+    or `interval` seconds have passed. Journals left by dead processes
+    are replayed on start; compliments already in the table are skipped,
+    so a replay never adds duplicates.
+    """
+
+    def __init__(self, max_size=10000, batch_size=200, interval=1.0,
+                 folder=None):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.folder = folder
+        self.pending = []
+        self.flushed = 0
+        self.rejected = 0
+        self._cond = Condition()
+        self._journal = None
+        self._closing = False
+
+    def submit(self, compliment, gender):
+        """Queues a compliment, returning False if the spool is full."""
+        record = {'compliment': compliment, 'gender': gender,
+                  'user_id': None, 'approved': False,
+                  'text_hash': text_hash(compliment)}
+        with self._cond:
+            self.start()
+            if self._closing or len(self.pending) >= self.max_size:
+                self.rejected += 1
+                return False
+            if self._journal:
+                self._journal.write(json.dumps(record) + '\n')
+                self._journal.flush()
+            self.pending.append(record)
+            if len(self.pending) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def size(self):
+        return len(self.pending)
+
+    def prepare_process(self):
+        # Anything inherited from the parent is the parent's to flush.
+        self.pending = []
+        self._closing = False
+        if self.folder:
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            self._journal = open(self.journal_path(), 'a')
+
+    def close(self):
+        """Flushes everything still queued and stops the flusher."""
+        with self._cond:
+            if not self.running_here() or self._closing:
+                return
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+
+    def journal_path(self, pid=None, suffix='jsonl'):
+        return os.path.join(self.folder, 'spool-%d.%s'
+                            % (pid or os.getpid(), suffix))
+
+    def run(self):
+        if self.folder:
+            self.recover()
+        while True:
+            with self._cond:
+                deadline = time.time() + self.interval
+                while (len(self.pending) < self.batch_size and
+                       not self._closing and time.time() < deadline):
+                    self._cond.wait(deadline - time.time())
+                batch, self.pending = self.pending, []
+                flushing = self.rotate_journal() if batch else None
+                closing = self._closing
+            try:
+                self.flush(batch)
+            except Exception:
+                app.logger.exception("Could not flush %d spooled "
+                                     "compliments", len(batch))
+                # Requeued; the .flushing journal keeps them until a flush
+                # succeeds.
+                with self._cond:
+                    self.pending[:0] = batch
+                if closing:
+                    return
+                time.sleep(self.interval)
+                continue
+            if flushing:
+                os.remove(flushing)
+            if closing:
+                if self._journal:
+                    self._journal.close()
+                    os.remove(self.journal_path())
+                return
+
+    def rotate_journal(self):
+        """Moves the journal aside while its records are flushed."""
+        if not self._journal:
+            return None
+        self._journal.close()
+        flushing = self.journal_path(suffix='flushing')
+        if os.path.exists(flushing):
+            # A failed flush left records behind; keep them with these.
+            with open(flushing, 'a') as f, open(self.journal_path()) as new:
+                f.write(new.read())
+            os.remove(self.journal_path())
+        else:
+            os.rename(self.journal_path(), flushing)
+        self._journal = open(self.journal_path(), 'a')
+        return flushing
+
+    def flush(self, records):
+        """Inserts records not already in the table, a batch at a time."""
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            hashes = set(record['text_hash'] for record in batch)
+            try:
+                with db.engine.begin() as connection:
+                    existing = set(row[0] for row in connection.execute(
+                        select([Compliment.text_hash])
+                        .where(Compliment.text_hash.in_(hashes))
+                        .where(Compliment.user_id == None)))
+                    rows = []
+                    for record in batch:
+                        if record['text_hash'] not in existing:
+                            existing.add(record['text_hash'])
+                            rows.append(record)
+                    if rows:
+                        connection.execute(Compliment.__table__.insert(),
+                                           rows)
+            except IntegrityError:
+                # Another worker added one of them since the check; the
+                # unique index rejects the copy, so go a row at a time.
+                rows = [record for record in rows
+                        if self.insert_new(record)]
+            self.flushed += len(rows)
+
+    def insert_new(self, record):
+        """Inserts one record unless it's a duplicate. Returns success."""
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(Compliment.__table__.insert(), record)
+        except IntegrityError:
+            return False
+        return True
+
+    def recover(self):
+        """Flushes journals left behind by processes that have exited."""
+        for path in glob(os.path.join(self.folder, 'spool-*')):
+            pid = journal_owner(path)
+            if not pid or pid == os.getpid() or process_alive(pid):
+                continue
+            # Claimed by renaming, so only one worker replays each file.
+            claimed = path + '.%d.recovering' % os.getpid()
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            with open(claimed) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            try:
+                self.flush(records)
+            except Exception:
+                app.logger.exception("Could not replay %s", path)
+                os.rename(claimed, path)
+                continue
+            os.remove(claimed)
+
+
+def journal_owner(path):
+    """Returns the pid of the process responsible for a journal file."""
+    parts = os.path.basename(path).split('.')
+    try:
+        if parts[-1] == 'recovering':
+            return int(parts[-2])
+        return int(parts[0][len('spool-'):])
+    except (ValueError, IndexError):
+        return None
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+compliment_spool = ComplimentSpool(
+    max_size=app.config.get('COMPLIMENT_SPOOL_MAX_SIZE', 10000),
+    batch_size=app.config.get('COMPLIMENT_SPOOL_BATCH_SIZE', 200),
+    interval=app.config.get('COMPLIMENT_SPOOL_INTERVAL', 1.0),
+    folder=app.config.get('COMPLIMENT_SPOOL_DIR'))
+atexit.register(compliment_spool.close)
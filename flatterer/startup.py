@@ -0,0 +1,88 @@
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class StartupTimer(object):
+    """Records how long each startup phase takes."""
+
+    def __init__(self):
+        self.started = self.last = time.time()
+        self.phases = []
+
+    def mark(self, phase):
+        """Ends `phase`, which started when the previous one ended."""
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        lines = ['%-10s %8.1f ms' % (phase, duration * 1000)
+                 for phase, duration in self.phases]
+        lines.append('%-10s %8.1f ms' % ('total',
+                                         (self.last - self.started) * 1000))
+        return '\n'.join(lines)
+
+
+class TemplateCache(FileSystemBytecodeCache):
+    """Bytecode cache whose folder is created when it is first written."""
+
+    def dump_bytecode(self, bucket):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another worker may have just created it.
+                if not os.path.isdir(self.directory):
+                    raise
+        FileSystemBytecodeCache.dump_bytecode(self, bucket)
+
+
+def configure_templates(app):
+    """Keeps compiled templates in JINJA_BYTECODE_CACHE_DIR, if set.
+
+    Must run before the Jinja environment is first used.
+    """
+    folder = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if not folder:
+        return
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=TemplateCache(folder))
+
+
+def precompile_templates(app):
+    """Loads every template so no request has to compile one."""
+    names = [name for name in app.jinja_env.list_templates()
+             if name.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+def warm_up(app):
+    """Opens pooled connections and loads the most used queries' data."""
+    from flatterer import db
+    from models import Gender, Complimentee
+    from cache import compliment_pool
+
+    pool = db.engine.pool
+    size = pool.size() if hasattr(pool, 'size') else 1
+    connections = [db.engine.connect() for i in range(size)]
+    for connection in connections:
+        connection.close()
+
+    for gender in Gender.query.all():
+        compliment_pool.get(gender.gender)
+    Complimentee.query.order_by(Complimentee.id).limit(1).all()
+    db.session.remove()
+
+
+def boot(app, timer, warm=False):
+    """Runs the startup steps configured for a server process."""
+    if app.config.get('PRECOMPILE_TEMPLATES', True):
+        precompile_templates(app)
+        timer.mark('templates')
+    if warm:
+        warm_up(app)
+        timer.mark('warm-up')
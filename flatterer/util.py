@@ -0,0 +1,62 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from threading import Thread
+
+
+@contextmanager
+def atomic_write(path, mode='wb', sync=False):
+    """Opens a file that replaces `path` once the block is done.
+
+    The data is written aside and renamed into place, so readers never see
+    a partial file; if the block raises, `path` is left as it was. With
+    `sync`, the data is on disk before the rename.
+    """
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # Another process may have just created it.
+            if not os.path.isdir(folder):
+                raise
+    fd, temp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(temp, 0644)
+        os.rename(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+class ProcessThread(object):
+    """Mixin for objects with a background thread in every process.
+
+    `start` runs `self.run` in a daemon thread the first time it is called
+    in a process, forked workers included, after `prepare_process` has
+    dropped whatever state was inherited from the parent. Callers hold the
+    object's lock, if it has one.
+    """
+    _pid = None
+    _thread = None
+
+    def start(self, *args):
+        if self.running_here():
+            return
+        self._pid = os.getpid()
+        self.prepare_process()
+        self._thread = Thread(target=self.run, args=args)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def running_here(self):
+        """Whether the thread was started by this process."""
+        return self._pid == os.getpid()
+
+    def prepare_process(self):
+        pass
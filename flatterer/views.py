@@ -1,14 +1,50 @@
-from random import shuffle
+import math
+from datetime import datetime, timedelta
 from functools import wraps
+from collections import namedtuple
 
 from flatterer import db, app, login_manager
+from database import primary_reads
 from forms import *
-from models import User, Gender, Compliment, Theme, Complimentee
+from models import (User, Gender, Compliment, Theme, Complimentee,
+                    text_hash)
+from cache import (compliment_pool, personal_pool, page_cache, user_cache,
+                   complimentee_cache, sample_compliments)
+from bulk import (delete_compliments, approve_compliment_ids,
+                  unapproved_compliments, complimentee_ids)
+from search import search_compliments, is_duplicate
+from spool import compliment_spool
+from analytics import view_counter, view_counts, view_history
+from publish import publish_scheduler
+from compression import stream_template
+from events import event_stream, events_enabled, publish_compliments
 
 from flask import (Blueprint, request, render_template, flash,
-                   g, session, redirect)
+                   g, session, redirect, jsonify, url_for, make_response)
 from flask.ext.login import (login_user, logout_user, current_user,
                              login_required)
+from sqlalchemy import select, union_all, literal, func, case, exists
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from werkzeug.local import LocalProxy
+
+# Number of compliments returned by the feeds, and the most a client may ask
+# for at once.
+FEED_BATCH_SIZE = 10
+FEED_BATCH_MAX = 50
+
+# Sections of the control panel as (key, title, criterion). The key doubles
+# as the query string argument holding the section's page cursor.
+CONTROL_PANEL_SECTIONS = [
+    ('male', "Male Compliments", Compliment.gender == "Male"),
+    ('female', "Female Compliments", Compliment.gender == "Female"),
+    ('any', "Any Gender Compliments", Compliment.gender == "Any"),
+    ('personal', "Personal Compliments", Compliment.gender == None),
+    ('unapproved', "Unapproved Compliments", Compliment.approved == False),
+]
+
+Section = namedtuple('Section', ['key', 'title', 'compliments', 'count',
+                                 'next_url', 'first_url'])
 
 
 def require_admin(f):
@@ -21,13 +57,23 @@ def require_admin(f):
     return decorated_function
 
 
+def read_only(f):
+    """Sends the queries of a view to the read replica, if one is set."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.read_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 def require_complimentee_perms(f):
-    """Requires someone to have permission to edit a complimentee."""
+    """Requires someone to have permission to edit a complimentee.
+
+    The complimentee is passed on to the view as `complimentee`.
+    """
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        complimentee = (Complimentee.query
-                        .filter_by(url=kwargs['user_url'])
-                        .first())
+        complimentee = resolve_complimentee(kwargs['user_url'])
         if complimentee:
             if complimentee.owner != g.user.id:
                 return no_perms('You can not edit a complimentee '
@@ -35,17 +81,31 @@ def require_complimentee_perms(f):
         else:
             return no_perms('The complimentee you are looking for '
                             'does not exist!')
+        kwargs['complimentee'] = complimentee
         return f(*args, **kwargs)
     return decorated_function
 
 
+def lazy(factory):
+    """Returns a proxy to the result of calling `factory` on first use."""
+    value = []
+
+    def get():
+        if not value:
+            value.append(factory())
+        return value[0]
+    return LocalProxy(get)
+
+
 @app.before_request
 def before_request():
-    """Do stuff before a request happens."""
+    """Do stuff before a request happens.
+
+    Both values are proxies, so requests that never touch them skip loading
+    the user and building the login form.
+    """
     g.user = current_user
-    if g.user is None:
-        g.user = User("", "Guest", "")
-    g.login_form = LoginForm()
+    g.login_form = lazy(LoginForm)
 
 
 @app.route("/")
@@ -81,6 +141,7 @@ def register():
                         password=form.password.data, admin=form.admin.data)
             db.session.add(user)
             db.session.commit()
+            user_cache.invalidate(user.id)
             login_user(user)
             flash("Registered and logged in successfully!")
             return render_template('home.html', user=g.user,
@@ -94,7 +155,14 @@ def register():
 # For Flask-Login
 @login_manager.user_loader
 def load_user(userid):
-    return User.query.filter_by(id=userid).first()
+    user = user_cache.get(int(userid))
+    if user is None:
+        user = User.query.filter_by(id=userid).first()
+        if user:
+            # Detached, so it can outlive the session of this request.
+            db.session.expunge(user)
+            user_cache.set(user.id, user)
+    return user
 
 
 # For Flask-Login
@@ -119,6 +187,7 @@ def login():
         # login and validate the user...
         user = User.query.filter_by(username=form.username.data).first()
         if user and user.check_password(form.password.data):
+            user_cache.invalidate(user.id)
             login_user(user)
             flash("Logged in successfully.")
             print "User=" + user.name
@@ -129,6 +198,8 @@ def login():
 @app.route("/logout", methods=['POST'])
 def logout():
     """Logs out a user."""
+    if not g.user.is_anonymous():
+        user_cache.invalidate(g.user.id)
     logout_user()
     flash("Logged out successfully!")
     return redirect("/")
@@ -158,7 +229,9 @@ def add_complimentee():
     msg = ""
     if request.method == "POST":
         exists = Complimentee.query.filter_by(url=form.url.data).first()
-        if form.url.data and not exists:
+        if not form.url.validate(form):
+            msg = form.url.errors[0]
+        elif not exists:
             complimentee = Complimentee(form.name.data,
                                         form.url.data,
                                         owner=g.user.id,
@@ -195,106 +268,202 @@ def add_compliment():
     form = AddCompliment()
     msg = ""
 
+    status = 200
+
     if request.method == "POST":
-        add_compliment(form)
-        msg = "Compliment successfully added!"
+        if (app.config.get('COMPLIMENT_SPOOL_ENABLED') and
+                (g.user.is_anonymous() or not g.user.admin)):
+            # Unapproved compliments aren't shown anywhere until approved,
+            # so they can be written in batches a little later.
+            if not form.validate():
+                msg = "Please enter a compliment."
+            elif is_duplicate(text_hash(form.compliment.data)):
+                msg = "This compliment has already been submitted!"
+            elif compliment_spool.submit(form.compliment.data,
+                                         form.gender.data):
+                msg = "Compliment successfully added!"
+            else:
+                msg = "We're getting lots of compliments, please try again!"
+                status = 503
+        elif add_compliment(form):
+            msg = "Compliment successfully added!"
+        else:
+            msg = "This compliment has already been submitted!"
 
-    return render_template('add_compliment.html', login_form=g.login_form,
-                           form=form, user=g.user, msg=msg)
+    response = make_response(render_template(
+        'add_compliment.html', login_form=g.login_form, form=form,
+        user=g.user, msg=msg), status)
+    if status == 503:
+        response.headers['Retry-After'] = str(
+            int(math.ceil(compliment_spool.interval)))
+    return response
 
 
 @app.route("/<user_url>/add_compliment", methods=['GET', 'POST'])
 @login_required
 @require_complimentee_perms
-def add_individual_compliment(user_url):
+def add_individual_compliment(user_url, complimentee):
     """Add compliment for a given individual."""
     form = AddCompliment()
     msg = ""
-    user = Complimentee.query.filter_by(url=user_url).first()
     if request.method == "POST":
-        add_compliment(form, user_id=user.id)
-        msg = "Compliment successfully added!"
-    return render_template('add_compliment.html', name=user.name, url=user_url,
-                           login_form=g.login_form, form=form,
+        if add_compliment(form, user_id=complimentee.id):
+            page_cache.invalidate(user_url)
+            publish_scheduler.schedule([complimentee.id])
+            msg = "Compliment successfully added!"
+        else:
+            msg = "This compliment has already been submitted!"
+    return render_template('add_compliment.html', name=complimentee.name,
+                           url=user_url, login_form=g.login_form, form=form,
                            user=g.user, msg=msg)
 
 
 @app.route("/<user_url>/edit_theme/", methods=['GET', 'POST'])
 @login_required
 @require_complimentee_perms
-def edit_theme(user_url):
+def edit_theme(user_url, complimentee):
     """Edit the theme for a given user."""
     form = AddTheme()
-    user = Complimentee.query.filter_by(url=user_url).first()
-    theme = Theme.query.filter_by(user_id=user.id).first()
+    theme = complimentee.theme[0] if complimentee.theme else None
     msg = ""
     if not theme:
         return redirect('/'+user_url+'/add_theme')
 
     if request.method == "POST":
-        theme.theme_path = form.theme_path.data
-        theme.song_path = form.song_path.data
+        # The cached theme is shared between requests, so it is updated
+        # in the database rather than changed in place.
+        (Theme.query
+         .filter_by(id=theme.id)
+         .update(Theme.path_values(form.theme_path.data,
+                                   form.song_path.data),
+                 synchronize_session=False))
         db.session.commit()
+        complimentee_cache.invalidate(user_url)
+        page_cache.invalidate(user_url)
+        publish_scheduler.schedule([complimentee.id])
         msg = "Theme added successfully!"
-        return redirect(user.url+'/add_compliment')
+        return redirect(complimentee.url+'/add_compliment')
 
-    theme = Theme.query.filter_by(user_id=user.id).first()
     form.theme_path.data = theme.theme_path
     form.song_path.data = theme.song_path
 
     return render_template('edit_theme.html', login_form=g.login_form,
-                           form=form, user=g.user, name=user.name)
+                           form=form, user=g.user, name=complimentee.name)
 
 
 @app.route("/<user_url>/add_theme/", methods=['GET', 'POST'])
 @login_required
 @require_complimentee_perms
-def add_theme(user_url):
+def add_theme(user_url, complimentee):
     """Add a theme for a given user."""
     form = AddTheme()
-    user = Complimentee.query.filter_by(url=user_url).first()
 
     if request.method == "POST":
         if form.theme_path.data or form.song_path.data:
-            theme = Theme(user.id, form.theme_path.data, form.song_path.data)
+            theme = Theme(complimentee.id, form.theme_path.data,
+                          form.song_path.data)
             db.session.add(theme)
             db.session.commit()
+            complimentee_cache.invalidate(user_url)
+            page_cache.invalidate(user_url)
+            publish_scheduler.schedule([complimentee.id])
         return redirect(user_url+'/add_compliment')
 
     return render_template('add_theme.html', login_form=g.login_form,
-                           form=form, user=g.user, name=user.name)
+                           form=form, user=g.user, name=complimentee.name)
 
 
 @login_required
 @app.route("/list_complimentees", methods=['GET', 'POST'])
+@read_only
 def list_complimentees():
     """List complimentees for a given account."""
 
     complimentees = Complimentee.query.filter_by(owner=g.user.id).all()
-    return render_template("list_complimentees.html", login_form=g.login_form,
-                           user=g.user, complimentees=complimentees)
+    views = view_counts([complimentee.id for complimentee in complimentees],
+                        since=datetime.utcnow() - timedelta(days=7))
+    return stream_template("list_complimentees.html", login_form=g.login_form,
+                           user=g.user, complimentees=complimentees,
+                           views=views)
+
+
+@app.route("/<user_url>/views")
+@login_required
+@require_complimentee_perms
+@read_only
+def complimentee_views(user_url, complimentee):
+    """Returns a complimentee's page views per time bucket as JSON.
+
+    `days` limits the history to recent buckets; the default is 30.
+    """
+    days = request.args.get('days', 30, type=int)
+    history = view_history(complimentee.id,
+                           since=datetime.utcnow() - timedelta(days=days))
+    return jsonify(url=user_url, total=sum(views for bucket, views in history),
+                   views=[dict(bucket=bucket.isoformat() + 'Z', views=views)
+                          for bucket, views in history])
 
 
 @app.route("/compliment/<gender>/<name>", methods=['GET', 'POST'])
+@read_only
 def compliment_gender_name(gender, name):
     """Compliment someone based on their gender and name.
 
-    TODO: Change this to use _or, instead of appending query results.
+    The page itself carries no compliments; they are fetched in small
+    batches from the gender feed.
     """
-    gender_compliments = (Compliment.query
-                          .filter_by(gender=gender)
-                          .filter_by(approved=True)
-                          .all())
-    any_compliments = (Compliment.query
-                       .filter_by(gender="Any")
-                       .filter_by(approved=True)
-                       .all())
-
-    compliments = gender_compliments + any_compliments
-
-    shuffle(compliments)
     return render_template("compliment.html", login_form=g.login_form,
-                           name=name, user=g.user, compliments=compliments)
+                           name=name, user=g.user,
+                           feed_url=url_for('gender_feed', gender=gender),
+                           events_url=events_enabled() and
+                           url_for('gender_events', gender=gender))
+
+
+@app.route("/feed/gender/<gender>")
+@read_only
+def gender_feed(gender):
+    """Returns a random batch of approved compliments for a gender."""
+    pools = [compliment_pool.get(gender)]
+    if gender != "Any":
+        pools.append(compliment_pool.get("Any"))
+    return compliment_feed(pools)
+
+
+@app.route("/feed/user/<user_url>")
+@read_only
+def individual_feed(user_url):
+    """Returns a random batch of a complimentee's personal compliments."""
+    user = resolve_complimentee(user_url)
+    if not user:
+        return jsonify(compliments=[]), 404
+    return compliment_feed([personal_pool.get(user.id)])
+
+
+@app.route("/events/gender/<gender>", methods=['GET'])
+def gender_events(gender):
+    """Streams compliments as they are approved for a gender."""
+    channels = ['gender:' + gender]
+    if gender != "Any":
+        channels.append('gender:Any')
+    return event_stream(channels)
+
+
+@app.route("/events/user/<user_url>", methods=['GET'])
+def individual_events(user_url):
+    """Streams a complimentee's personal compliments as they are added."""
+    user = resolve_complimentee(user_url)
+    if not user:
+        return "The complimentee does not exist!", 404
+    return event_stream(['user:%d' % user.id])
+
+
+def compliment_feed(pools):
+    """Samples a batch of compliments from the pools as a JSON response."""
+    count = request.args.get('count', FEED_BATCH_SIZE, type=int)
+    count = max(1, min(count, FEED_BATCH_MAX))
+    compliments = sample_compliments(pools, count)
+    return jsonify(compliments=[compliment._asdict()
+                                for compliment in compliments])
 
 
 @app.route("/control_panel", methods=['GET', 'POST'])
@@ -311,49 +480,176 @@ def compliment_control_panel():
         approve_compliments(approved_ids)
         msg += str(len(approved_ids))+" compliments approved!"
 
-    male_comps = Compliment.query.filter_by(gender="Male").all()
-    female_comps = Compliment.query.filter_by(gender="Female").all()
-    any_comps = Compliment.query.filter_by(gender="Any").all()
-    personal_comps = Compliment.query.filter_by(gender=None).all()
-
-    compliment_titles = ["Male Compliments", "Female Compliments",
-                         "Any Gender Compliments", "Personal Compliments"]
-
-    compliment_list = [male_comps, female_comps,  any_comps, personal_comps]
-    compliment_info = zip(compliment_titles, compliment_list)
-
-    unapproved_comps = Compliment.query.filter_by(approved=False).all()
+    page_size = app.config.get('CONTROL_PANEL_PAGE_SIZE', 50)
+    cursors = dict((key, request.args.get(key, 0, type=int))
+                   for key, title, criterion in CONTROL_PANEL_SECTIONS)
+    pages = load_control_panel_pages(cursors, page_size)
+    counts = count_control_panel_sections()
+
+    sections = []
+    for key, title, criterion in CONTROL_PANEL_SECTIONS:
+        compliments = pages[key][:page_size]
+        next_url = first_url = None
+        if len(pages[key]) > page_size:
+            next_url = control_panel_url(cursors, key, compliments[-1].id)
+        if cursors[key]:
+            first_url = control_panel_url(cursors, key, 0)
+        sections.append(Section(key, title, compliments, counts[key],
+                                next_url, first_url))
+
+    return stream_template("control_panel.html", login_form=g.login_form,
+                           user=g.user, compliment_info=sections[:-1],
+                           unapproved=sections[-1], msg=msg)
+
+
+def load_control_panel_pages(cursors, page_size):
+    """Loads a keyset page for every control panel section in one query.
+
+    Each section fetches one row more than `page_size` so the caller can
+    tell whether there is a next page. Returns a dict of compliment lists
+    keyed by section, with each compliment's complimentee already loaded.
+    """
+    pages = []
+    for key, title, criterion in CONTROL_PANEL_SECTIONS:
+        page = (select([Compliment.id])
+                .where(criterion)
+                .where(Compliment.id > cursors[key])
+                .order_by(Compliment.id)
+                .limit(page_size + 1)
+                .alias())
+        pages.append(select([literal(key).label('section'), page.c.id]))
+    pages = union_all(*pages).alias()
+
+    rows = (db.session.query(pages.c.section, Compliment)
+            .filter(Compliment.id == pages.c.id)
+            .options(joinedload(Compliment.user))
+            .order_by(Compliment.id))
+    sections = dict((key, []) for key, title, criterion
+                    in CONTROL_PANEL_SECTIONS)
+    for section, compliment in rows:
+        sections[section].append(compliment)
+    return sections
+
+
+def count_control_panel_sections():
+    """Counts the compliments in every control panel section in one query."""
+    counts = (db.session.query(*[func.sum(case([(criterion, 1)], else_=0))
+                                 for key, title, criterion
+                                 in CONTROL_PANEL_SECTIONS])
+              .one())
+    return dict((key, count or 0) for (key, title, criterion), count
+                in zip(CONTROL_PANEL_SECTIONS, counts))
+
+
+def control_panel_url(cursors, key, cursor):
+    """Builds a control panel URL with one section's cursor moved."""
+    args = dict((k, v) for k, v in cursors.items() if v and k != key)
+    if cursor:
+        args[key] = cursor
+    return url_for('compliment_control_panel', **args)
+
+
+@app.route("/control_panel/search")
+@require_admin
+def search():
+    """Full-text search over compliments, best matches first.
 
-    return render_template("control_panel.html", login_form=g.login_form,
-                           user=g.user, compliment_info=compliment_info,
-                           unapproved_comps=unapproved_comps, msg=msg)
+    Filters on gender ("None" for personal compliments), approved and
+    complimentee url. Returns JSON when `format=json` is given.
+    """
+    terms = request.args.get('q', u'').strip()
+    gender = request.args.get('gender') or None
+    complimentee = request.args.get('complimentee') or None
+    approved = request.args.get('approved')
+    approved = {'1': True, '0': False}.get(approved)
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = app.config.get('SEARCH_PAGE_SIZE', 25)
+
+    compliments, has_next = [], False
+    if terms:
+        compliments, has_next = search_compliments(
+            terms, gender=gender, approved=approved,
+            complimentee=complimentee, page=page, per_page=per_page)
+
+    if request.args.get('format') == 'json':
+        return jsonify(page=page, has_next=has_next,
+                       compliments=[dict(id=c.id, compliment=c.compliment,
+                                         gender=c.gender, user_id=c.user_id,
+                                         approved=c.approved)
+                                    for c in compliments])
+
+    args = request.args.to_dict()
+    args.pop('page', None)
+    next_url = prev_url = None
+    if has_next:
+        next_url = url_for('search', page=page + 1, **args)
+    if page > 1:
+        prev_url = url_for('search', page=page - 1, **args)
+    return stream_template("search.html", login_form=g.login_form,
+                           user=g.user, compliments=compliments, q=terms,
+                           genders=Gender.query.all(), args=args,
+                           next_url=next_url, prev_url=prev_url)
 
 
 @app.route("/compliment/<user_url>")
+@read_only
 def compliment_individual(user_url):
-    """Compliment a given user."""
-    youtube = 0
-    user = check_for_complimentee(user_url)
-    if not user:
+    """Compliment a given user.
+
+    Pages rendered for anonymous visitors don't depend on who is viewing,
+    so they are cached by URL until the complimentee's compliments or theme
+    change.
+    """
+    anonymous = g.user.is_anonymous()
+    if anonymous:
+        cached = page_cache.get(user_url)
+        if cached is not None:
+            complimentee_id, page = cached
+            count_view(complimentee_id)
+            return page
+
+    # Loads the complimentee, their theme and whether they have any
+    # compliments in a single query, from the primary if the page is
+    # going to be cached.
+    has_compliments = (exists()
+                       .where(Compliment.user_id == Complimentee.id)
+                       .label('has_compliments'))
+    with primary_reads(anonymous):
+        result = (db.session.query(Complimentee, has_compliments)
+                  .options(joinedload(Complimentee.theme))
+                  .filter(Complimentee.url == user_url)
+                  .first())
+    if not result:
         return no_perms("The user you are trying to compliment "
                         "does not exist!")
-    compliments = Compliment.query.filter_by(user_id=user.id).all()
-    theme = Theme.query.filter_by(user_id=user.id).first()
-    if theme:
-        youtube = str(theme.song_path).count("youtube")
-        theme.song_path = theme.song_path.replace("watch?v=", "embed/")
-    if compliments:
-        greeting = Complimentee.query.filter_by(id=user.id).first().greeting
-        return render_template("compliment_individual.html", user=g.user,
-                               login_form=g.login_form, youtube=youtube,
-                               greeting=greeting, name=user.name, theme=theme,
-                               compliments=compliments)
-    else:
+    user, has_compliments = result
+    if not has_compliments:
         return "The name you provided is not in the database!"
 
+    theme = user.theme[0] if user.theme else None
+    page = render_template("compliment_individual.html", user=g.user,
+                           login_form=g.login_form, greeting=user.greeting,
+                           name=user.name, theme=theme,
+                           feed_url=url_for('individual_feed',
+                                            user_url=user_url),
+                           events_url=events_enabled() and
+                           url_for('individual_events', user_url=user_url))
+    if anonymous:
+        page_cache.set(user_url, (user.id, page))
+    count_view(user.id)
+    return page
+
+
+def count_view(complimentee_id):
+    if app.config.get('VIEW_COUNTS_ENABLED', True):
+        view_counter.record(complimentee_id)
+
 
 def add_compliment(form, user_id=None):
-    """Adds a compliment for a given user_id."""
+    """Adds a compliment for a given user_id.
+
+    Returns False, adding nothing, if the same text was already submitted.
+    """
     if user_id:
         compliment = Compliment(compliment=form.compliment.data,
                                 user_id=user_id, approved=True)
@@ -366,28 +662,83 @@ def add_compliment(form, user_id=None):
                                 approved=approved)
         print "Gender specific compliment added." + str(approved)
 
+    if is_duplicate(compliment.text_hash, user_id):
+        return False
     db.session.add(compliment)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # The same compliment was added since is_duplicate looked.
+        db.session.rollback()
+        return False
+    # Read before the commit expires them.
+    added = (compliment.id, compliment.compliment, compliment.gender,
+             compliment.user_id)
+    approved = compliment.approved
     db.session.commit()
+    if user_id:
+        personal_pool.invalidate(user_id)
+    elif approved:
+        compliment_pool.invalidate(added[2])
+    if approved:
+        publish_compliments([added])
+    return True
 
 
 def remove_compliments(compliment_ids):
     """Batch removes compliments based on their ids."""
-    removals = (db.session.query(Compliment)
-                    .filter(Compliment.id.in_(compliment_ids)).all())
-    for removal in removals:
-        db.session.delete(removal)
+    if not compliment_ids:
+        return
+    changed = complimentee_ids(compliment_ids)
+    delete_compliments(compliment_ids)
     db.session.commit()
+    compliment_pool.invalidate()
+    personal_pool.invalidate()
+    page_cache.invalidate()
+    if changed:
+        publish_scheduler.schedule(changed)
 
 
 def approve_compliments(compliment_ids):
     """Batch approve compliments."""
-    approvals = (db.session.query(Compliment)
-                    .filter(Compliment.id.in_(compliment_ids)).all())
-    for compliment in approvals:
-        compliment.approved = True
+    if not compliment_ids:
+        return
+    approved = []
+    if events_enabled():
+        approved = unapproved_compliments(compliment_ids)
+    approve_compliment_ids(compliment_ids)
     db.session.commit()
+    compliment_pool.invalidate()
+    personal_pool.invalidate()
+    page_cache.invalidate()
+    publish_compliments(approved)
 
 
-def check_for_complimentee(url):
-    """Check to see if a complimentee exists."""
-    return Complimentee.query.filter_by(url=url).first()
+def resolve_complimentee(url):
+    """Returns the complimentee with a url, with their theme, or None.
+
+    Each complimentee is looked up at most once per request, and is then
+    kept in complimentee_cache for the next requests. The cached rows are
+    detached and shared between threads, so they must not be changed;
+    edits update the database and invalidate the url instead.
+    """
+    resolved = getattr(g, 'complimentees', None)
+    if resolved is None:
+        resolved = g.complimentees = {}
+    if url in resolved:
+        return resolved[url]
+
+    complimentee = complimentee_cache.get(url)
+    if complimentee is None:
+        with primary_reads():
+            complimentee = (Complimentee.query
+                            .options(joinedload(Complimentee.theme))
+                            .filter_by(url=url)
+                            .first())
+        if complimentee:
+            for theme in complimentee.theme:
+                db.session.expunge(theme)
+            db.session.expunge(complimentee)
+            complimentee_cache.set(url, complimentee)
+    resolved[url] = complimentee
+    return complimentee
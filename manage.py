@@ -1,17 +1,140 @@
 import sys
 import argparse
+import multiprocessing
 
 sys.dont_write_bytecode = True
-from flatterer import app
+from flatterer import app, startup_timer
+from flatterer.startup import boot, warm_up, precompile_templates
+
+
+def runserver(args):
+    boot(app, startup_timer, warm=args.warm_up)
+    print startup_timer.report()
+    # Threaded, so open event streams don't hold up other requests.
+    app.run(args.ip, args.port, debug=args.debug, threaded=True)
+
+
+def serve(args):
+    from flatterer.server import PreforkServer
+    # Templates compiled here are shared by every forked worker; warming
+    # up opens connections, so that happens in each worker instead.
+    boot(app, startup_timer)
+    print startup_timer.report()
+    PreforkServer(args.ip, args.port, app, workers=args.workers,
+                  threads=args.threads, max_requests=args.max_requests,
+                  warm_up=(lambda: warm_up(app)) if args.warm_up
+                  else None).run()
+
+
+def compile_templates(args):
+    print "%d templates compiled." % len(precompile_templates(app))
+
+
+def publish(args):
+    from flatterer.publish import publish, publish_folder
+    if not publish_folder():
+        sys.exit("Set PUBLISH_DIR in config.py first.")
+    published, removed = publish(full=args.full, processes=args.processes)
+    print "%d pages published, %d removed." % (published, removed)
+
+
+def write_snapshot(args):
+    from flatterer.snapshot import write_snapshot, snapshot_path
+    if not snapshot_path():
+        sys.exit("Set COMPLIMENT_SNAPSHOT_PATH in config.py first.")
+    print "Snapshot generation %d written." % write_snapshot()
+
+
+def export_compliments(args):
+    from flatterer.bulk import export_compliments
+    out = open(args.file, 'wb') if args.file != '-' else sys.stdout
+    count = export_compliments(out, args.format, args.batch_size)
+    out.flush()
+    print >> sys.stderr, "%d compliments exported." % count
+
+
+def import_compliments(args):
+    from flatterer.bulk import import_compliments
+    infile = open(args.file, 'rb') if args.file != '-' else sys.stdin
+    count = import_compliments(infile, args.format, args.batch_size)
+    print >> sys.stderr, "%d compliments imported." % count
+
+
+def build_assets(args):
+    from flatterer.assets import build_assets
+    print "%d assets built." % len(build_assets())
+
 
 parser = argparse.ArgumentParser()
-parser.add_argument("-i", "--ip", help="listen to this IP address",
-                    default="0.0.0.0")
-parser.add_argument("-p", "--port", help="listen to this port",
-                    default="8080", type=int)
-parser.add_argument("-d", "--debug", help="turn debugging on",
-                    default="--debug")
+subparsers = parser.add_subparsers()
+
+run_parser = subparsers.add_parser("runserver", help="run the dev server")
+serve_parser = subparsers.add_parser(
+    "serve", help="run the multi-process production server")
+for server_parser in (run_parser, serve_parser):
+    server_parser.add_argument("-i", "--ip", help="listen to this IP address",
+                               default="0.0.0.0")
+    server_parser.add_argument("-p", "--port", help="listen to this port",
+                               default="8080", type=int)
+    server_parser.add_argument("--warm-up", help="prime the database pool "
+                               "and compliment caches before serving",
+                               action="store_true",
+                               default=app.config.get('WARM_UP_ON_STARTUP',
+                                                      False))
+run_parser.add_argument("-d", "--debug", help="turn debugging on",
+                        action="store_true")
+run_parser.set_defaults(func=runserver)
+
+serve_parser.add_argument("-w", "--workers", help="worker processes",
+                          default=app.config.get('SERVER_WORKERS') or
+                          multiprocessing.cpu_count(), type=int)
+serve_parser.add_argument("-t", "--threads", help="threads per worker",
+                          default=app.config.get('SERVER_THREADS', 4),
+                          type=int)
+serve_parser.add_argument("-m", "--max-requests",
+                          help="replace a worker after this many requests, "
+                          "0 for never",
+                          default=app.config.get('SERVER_MAX_REQUESTS', 0),
+                          type=int)
+serve_parser.set_defaults(func=serve)
+
+for name, func, help in [
+        ("export", export_compliments, "write compliments to a file"),
+        ("import", import_compliments, "load compliments from a file")]:
+    bulk_parser = subparsers.add_parser(name, help=help)
+    bulk_parser.add_argument("file", help="file to use, or - for stdio")
+    bulk_parser.add_argument("-f", "--format", choices=["jsonl", "csv"],
+                             default="jsonl")
+    bulk_parser.add_argument("-b", "--batch-size", help="rows per batch",
+                             default=1000, type=int)
+    bulk_parser.set_defaults(func=func)
+
+assets_parser = subparsers.add_parser(
+    "build_assets", help="fingerprint and precompress static files")
+assets_parser.set_defaults(func=build_assets)
+
+templates_parser = subparsers.add_parser(
+    "compile_templates", help="fill the Jinja bytecode cache")
+templates_parser.set_defaults(func=compile_templates)
+
+publish_parser = subparsers.add_parser(
+    "publish", help="render complimentee pages to static files")
+publish_parser.add_argument("--full", help="render every page again, in "
+                            "parallel, instead of only the changed ones",
+                            action="store_true")
+publish_parser.add_argument("-j", "--processes", help="processes for a "
+                            "full publish, one per CPU by default",
+                            type=int)
+publish_parser.set_defaults(func=publish)
+
+snapshot_parser = subparsers.add_parser(
+    "snapshot", help="rewrite the shared compliment snapshot")
+snapshot_parser.set_defaults(func=write_snapshot)
 
-args = parser.parse_args()
+# Running with no command, or only server options, starts the dev server.
+argv = sys.argv[1:]
+if not argv or argv[0].startswith("-") and argv[0] not in ("-h", "--help"):
+    argv.insert(0, "runserver")
 
-app.run(args.ip, args.port, debug=True)
+args = parser.parse_args(argv)
+args.func(args)
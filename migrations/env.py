@@ -1,8 +1,19 @@
 from __future__ import with_statement
+import os
+import sys
 from alembic import context
 from sqlalchemy import engine_from_config, pool
 from logging.config import fileConfig
 
+# Make the flatterer package and config.py importable when alembic is run
+# from anywhere.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Likewise online.py, for migration scripts that declare backfills.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from alembic.script import ScriptDirectory
+from flatterer import db
+from online import run_backfills, checkpoints
+
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
@@ -13,9 +24,22 @@ fileConfig(config.config_file_name)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
-# from myapp import mymodel
-# target_metadata = mymodel.Base.metadata
-target_metadata = None
+target_metadata = db.metadata
+
+# Left alone by autogenerate: the SQLite full-text index on compliments
+# and its shadow tables, which triggers keep in step (see
+# flatterer/search.py), the backfill checkpoints of online.py and the
+# partial index models.py adds with DDL. None are in the models' metadata.
+UNMODELLED_INDEXES = ['ux_compliments_gendered_text_hash']
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == 'table' and reflected and compare_to is None:
+        return not (name == checkpoints.name or
+                    name.startswith('compliments_fts'))
+    if type_ == 'index':
+        return name not in UNMODELLED_INDEXES
+    return True
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -35,10 +59,14 @@ def run_migrations_offline():
 
     """
     url = config.get_main_option("sqlalchemy.url")
-    context.configure(url=url)
+    context.configure(url=url, target_metadata=target_metadata,
+                      include_object=include_object)
 
     with context.begin_transaction():
         context.run_migrations()
+    # Backfills read the rows they change, so they need a live database.
+    context.execute("-- Data backfills are skipped in offline mode; run "
+                    "'alembic upgrade head' online to apply them.")
 
 def run_migrations_online():
     """Run migrations in 'online' mode.
@@ -55,12 +83,23 @@ def run_migrations_online():
     connection = engine.connect()
     context.configure(
                 connection=connection,
-                target_metadata=target_metadata
+                target_metadata=target_metadata,
+                include_object=include_object
                 )
 
     try:
         with context.begin_transaction():
             context.run_migrations()
+        # Backfills run once the schema changes are committed, in batches
+        # of their own, so they don't hold locks for the whole upgrade.
+        # Unfinished ones from an earlier, interrupted run resume here too.
+        revision = context.get_context().get_current_revision()
+        run_backfills(connection, ScriptDirectory.from_config(config),
+                      revision,
+                      int(config.get_main_option('backfill_batch_size')
+                          or 1000),
+                      float(config.get_main_option('backfill_throttle')
+                            or 0))
     finally:
         connection.close()
 
@@ -0,0 +1,167 @@
+"""Batched, resumable data backfills for migrations.
+
+A migration declares its data changes with a module-level ``backfills()``
+function returning Backfill objects instead of updating rows in
+``upgrade()``. env.py runs them after the schema changes are committed,
+walking the primary key in batches, each committed on its own with a
+pause in between, so the table is never locked for long. Progress is
+checkpointed in the alembic_backfills table; an interrupted backfill
+carries on from its last batch the next time migrations run.
+"""
+import time
+import logging
+from datetime import datetime
+
+import sqlalchemy as sa
+
+log = logging.getLogger('alembic.backfill')
+
+metadata = sa.MetaData()
+checkpoints = sa.Table(
+    'alembic_backfills', metadata,
+    sa.Column('name', sa.String(100), primary_key=True),
+    sa.Column('revision', sa.String(32), nullable=False),
+    sa.Column('last_id', sa.Integer, nullable=False),
+    sa.Column('rows', sa.Integer, nullable=False),
+    sa.Column('finished', sa.Boolean, nullable=False),
+    sa.Column('updated_at', sa.DateTime, nullable=False))
+
+
+class Backfill(object):
+    """A data change applied to `table` in primary key order.
+
+    Either `values`, a dict of column values or SQL expressions for an
+    UPDATE of each batch, or `process`, a function called as
+    ``process(connection, rows)`` with each batch of selected `columns`,
+    must be given. `where` limits the rows touched. `batch_size` and
+    `throttle` (seconds to sleep between batches) override the
+    backfill_batch_size and backfill_throttle options in alembic.ini.
+    """
+
+    def __init__(self, name, table, values=None, process=None, columns=(),
+                 where=None, pk='id', batch_size=None, throttle=None):
+        if (values is None) == (process is None):
+            raise ValueError("Give a backfill either values or process")
+        self.name = name
+        self.table = table
+        self.values = values
+        self.process = process
+        self.columns = columns
+        self.where = where
+        self.pk = table.c[pk]
+        self.batch_size = batch_size
+        self.throttle = throttle
+
+    def filtered(self, query):
+        if self.where is not None:
+            query = query.where(self.where)
+        return query
+
+    def run(self, connection, revision, batch_size=1000, throttle=0.0):
+        """Applies the backfill from its checkpoint; returns rows done."""
+        batch_size = self.batch_size or batch_size
+        throttle = self.throttle if self.throttle is not None else throttle
+        checkpoint = connection.execute(
+            checkpoints.select().where(checkpoints.c.name == self.name)
+        ).first()
+        if checkpoint and checkpoint.finished:
+            return 0
+        last_id = checkpoint.last_id if checkpoint else 0
+        rows_done = checkpoint.rows if checkpoint else 0
+        if not checkpoint:
+            connection.execute(checkpoints.insert(), name=self.name,
+                               revision=revision, last_id=0, rows=0,
+                               finished=False, updated_at=datetime.utcnow())
+
+        remaining = connection.execute(self.filtered(
+            sa.select([sa.func.count()]).select_from(self.table)
+            .where(self.pk > last_id))).scalar()
+        log.info("%s: %d rows to go from %s %d", self.name, remaining,
+                 self.pk.name, last_id)
+
+        started, done = time.time(), 0
+        while True:
+            query = self.filtered(
+                sa.select([self.pk] + [self.table.c[column]
+                                       for column in self.columns])
+                .where(self.pk > last_id)
+                .order_by(self.pk)
+                .limit(batch_size))
+            rows = connection.execute(query).fetchall()
+            if not rows:
+                break
+            high = rows[-1][0]
+
+            transaction = connection.begin()
+            try:
+                if self.values is not None:
+                    connection.execute(self.filtered(
+                        self.table.update()
+                        .where(self.pk > last_id)
+                        .where(self.pk <= high)
+                        .values(**self.values)))
+                else:
+                    self.process(connection, rows)
+                connection.execute(
+                    checkpoints.update()
+                    .where(checkpoints.c.name == self.name)
+                    .values(last_id=high, rows=rows_done + done + len(rows),
+                            updated_at=datetime.utcnow()))
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+
+            last_id = high
+            done += len(rows)
+            elapsed = time.time() - started
+            rate = done / elapsed if elapsed else 0
+            log.info("%s: %d/%d rows (%d%%), %.0f rows/s, %s left",
+                     self.name, done, remaining,
+                     100 * done / max(remaining, 1), rate,
+                     '%ds' % (max(remaining - done, 0) / rate)
+                     if rate else '?')
+            if len(rows) < batch_size:
+                break
+            if throttle:
+                time.sleep(throttle)
+
+        connection.execute(checkpoints.update()
+                           .where(checkpoints.c.name == self.name)
+                           .values(finished=True,
+                                   updated_at=datetime.utcnow()))
+        log.info("%s: finished, %d rows in %.1fs", self.name, done,
+                 time.time() - started)
+        return done
+
+
+def applied_scripts(script_directory, revision):
+    """Yields the scripts of `revision` and its ancestors, oldest first."""
+    chain = []
+    while revision:
+        script = script_directory.get_revision(revision)
+        chain.append(script)
+        revision = script.down_revision
+    return reversed(chain)
+
+
+def run_backfills(connection, script_directory, revision, batch_size=1000,
+                  throttle=0.0):
+    """Runs the unfinished backfills of every applied migration.
+
+    `connection` must not be inside a transaction; each batch is
+    committed separately.
+    """
+    metadata.create_all(connection)
+    for script in applied_scripts(script_directory, revision):
+        declare = getattr(script.module, 'backfills', None)
+        if not declare:
+            continue
+        for backfill in declare():
+            backfill.run(connection, script.revision, batch_size, throttle)
+
+
+def forget_backfill(op, name):
+    """Drops a backfill's checkpoint, for use in a migration's downgrade."""
+    if op.get_bind().dialect.has_table(op.get_bind(), 'alembic_backfills'):
+        op.execute(checkpoints.delete().where(checkpoints.c.name == name))
@@ -0,0 +1,63 @@
+"""Add indexes for the hot lookup columns and the complimentee owner key.
+
+Databases built with create_db.py already have these from the models; stamp
+them with `alembic stamp 3f2a9c1d7b04` instead of upgrading.
+
+Complimentees whose owner is not a user would violate the foreign key; the
+upgrade lists them and stops before changing anything.
+
+Revision ID: 3f2a9c1d7b04
+Revises: None
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b04'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # SQLite can't add constraints to an existing table.
+    add_foreign_key = op.get_bind().dialect.name != 'sqlite'
+    if add_foreign_key:
+        orphans = op.get_bind().execute(
+            "SELECT id, owner FROM complimentee "
+            "WHERE owner IS NOT NULL "
+            "AND owner NOT IN (SELECT id FROM users)").fetchall()
+        if orphans:
+            raise RuntimeError(
+                "Complimentees with owners that are not users (id: owner): "
+                "%s. Give them an existing owner or delete them, then "
+                "upgrade again." % ', '.join('%d: %d' % tuple(row)
+                                             for row in orphans))
+
+    # The compliment text is left out of these, as utf8 VARCHAR(255) keys
+    # are too long for InnoDB.
+    op.create_index('ix_compliments_gender_approved', 'compliments',
+                    ['gender', 'approved', 'id'])
+    op.create_index('ix_compliments_approved_gender', 'compliments',
+                    ['approved', 'gender'])
+    op.create_index('ix_compliments_user_id', 'compliments',
+                    ['user_id', 'id'])
+    op.create_index('ix_themes_user_id', 'themes', ['user_id'])
+    op.create_index('ix_complimentee_owner', 'complimentee', ['owner'])
+
+    if add_foreign_key:
+        op.create_foreign_key('fk_complimentee_owner_users', 'complimentee',
+                              'users', ['owner'], ['id'])
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_constraint('fk_complimentee_owner_users', 'complimentee',
+                           type_='foreignkey')
+
+    op.drop_index('ix_complimentee_owner', 'complimentee')
+    op.drop_index('ix_themes_user_id', 'themes')
+    op.drop_index('ix_compliments_user_id', 'compliments')
+    op.drop_index('ix_compliments_approved_gender', 'compliments')
+    op.drop_index('ix_compliments_gender_approved', 'compliments')
@@ -0,0 +1,88 @@
+"""Add compliment text hashes and full-text search indexes.
+
+Revision ID: 5e9d2b7a13c6
+Revises: 8c41e0b6d2a7
+Create Date: 2026-10-18 16:21:40.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e9d2b7a13c6'
+down_revision = '8c41e0b6d2a7'
+
+import re
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+from online import Backfill, forget_backfill
+
+SQLITE_FTS = [
+    "CREATE VIRTUAL TABLE compliments_fts USING fts5("
+    "compliment, content='compliments', content_rowid='id')",
+    "CREATE TRIGGER compliments_fts_insert AFTER INSERT ON compliments BEGIN "
+    "INSERT INTO compliments_fts(rowid, compliment) "
+    "VALUES (new.id, new.compliment); END",
+    "CREATE TRIGGER compliments_fts_delete AFTER DELETE ON compliments BEGIN "
+    "INSERT INTO compliments_fts(compliments_fts, rowid, compliment) "
+    "VALUES ('delete', old.id, old.compliment); END",
+    "CREATE TRIGGER compliments_fts_update AFTER UPDATE OF compliment "
+    "ON compliments BEGIN "
+    "INSERT INTO compliments_fts(compliments_fts, rowid, compliment) "
+    "VALUES ('delete', old.id, old.compliment); "
+    "INSERT INTO compliments_fts(rowid, compliment) "
+    "VALUES (new.id, new.compliment); END",
+    "INSERT INTO compliments_fts(compliments_fts) VALUES ('rebuild')",
+]
+
+
+def text_hash(compliment):
+    # Same rules as flatterer.models.text_hash at this revision.
+    words = re.findall(r'\w+', (compliment or u'').lower(), re.UNICODE)
+    return hashlib.sha1(u' '.join(words).encode('utf-8')).hexdigest()
+
+
+compliments = sa.sql.table('compliments',
+                           sa.sql.column('id', sa.Integer),
+                           sa.sql.column('compliment', sa.String),
+                           sa.sql.column('text_hash', sa.String))
+
+
+def hash_compliments(connection, rows):
+    for id, compliment in rows:
+        connection.execute(compliments.update()
+                           .where(compliments.c.id == id)
+                           .values(text_hash=text_hash(compliment)))
+
+
+def backfills():
+    return [Backfill('compliments.text_hash', compliments,
+                     process=hash_compliments, columns=['compliment'],
+                     where=compliments.c.text_hash == None)]
+
+
+def upgrade():
+    op.add_column('compliments', sa.Column('text_hash', sa.String(40)))
+    op.create_index('ix_compliments_text_hash', 'compliments',
+                    ['text_hash', 'user_id'])
+
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        for statement in SQLITE_FTS:
+            op.execute(statement)
+    elif dialect == 'mysql':
+        op.execute("CREATE FULLTEXT INDEX ix_compliments_fulltext "
+                   "ON compliments (compliment)")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        for trigger in ('insert', 'delete', 'update'):
+            op.execute("DROP TRIGGER compliments_fts_%s" % trigger)
+        op.execute("DROP TABLE compliments_fts")
+    elif dialect == 'mysql':
+        op.drop_index('ix_compliments_fulltext', 'compliments')
+    op.drop_index('ix_compliments_text_hash', 'compliments')
+    op.drop_column('compliments', 'text_hash')
+    forget_backfill(op, 'compliments.text_hash')
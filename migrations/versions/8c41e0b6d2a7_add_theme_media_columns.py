@@ -0,0 +1,56 @@
+"""Add precomputed media columns to themes.
+
+Revision ID: 8c41e0b6d2a7
+Revises: 3f2a9c1d7b04
+Create Date: 2026-10-18 15:04:12.562981
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c41e0b6d2a7'
+down_revision = '3f2a9c1d7b04'
+
+from alembic import op
+import sqlalchemy as sa
+from online import forget_backfill, Backfill
+
+themes = sa.sql.table('themes',
+                      sa.sql.column('id', sa.Integer),
+                      sa.sql.column('song_path', sa.String),
+                      sa.sql.column('song_embed_path', sa.String),
+                      sa.sql.column('media_kind', sa.String))
+
+
+def song_media(song_path):
+    # Same rules as flatterer.models.song_media at this revision.
+    if "youtube" in song_path:
+        return 'youtube', song_path.replace("watch?v=", "embed/")
+    return 'audio', song_path
+
+
+def set_song_media(connection, rows):
+    for id, song_path in rows:
+        media_kind, song_embed_path = song_media(song_path)
+        connection.execute(themes.update()
+                           .where(themes.c.id == id)
+                           .values(media_kind=media_kind,
+                                   song_embed_path=song_embed_path))
+
+
+def backfills():
+    # Themes without a song keep NULL in both columns.
+    return [Backfill('themes.media_kind', themes,
+                     process=set_song_media, columns=['song_path'],
+                     where=sa.and_(themes.c.song_path != None,
+                                   themes.c.song_path != ''))]
+
+
+def upgrade():
+    op.add_column('themes', sa.Column('song_embed_path', sa.String(255)))
+    op.add_column('themes', sa.Column('media_kind', sa.String(20)))
+
+
+def downgrade():
+    op.drop_column('themes', 'media_kind')
+    op.drop_column('themes', 'song_embed_path')
+    forget_backfill(op, 'themes.media_kind')
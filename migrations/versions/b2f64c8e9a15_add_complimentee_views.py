@@ -0,0 +1,28 @@
+"""Add per-bucket page view counts for complimentees.
+
+Revision ID: b2f64c8e9a15
+Revises: 5e9d2b7a13c6
+Create Date: 2026-10-18 17:02:33.540917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b2f64c8e9a15'
+down_revision = '5e9d2b7a13c6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'complimentee_views',
+        sa.Column('complimentee_id', sa.Integer,
+                  sa.ForeignKey('complimentee.id'), primary_key=True),
+        sa.Column('bucket', sa.Integer, primary_key=True,
+                  autoincrement=False),
+        sa.Column('views', sa.Integer, nullable=False))
+
+
+def downgrade():
+    op.drop_table('complimentee_views')
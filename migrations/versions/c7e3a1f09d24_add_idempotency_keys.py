@@ -0,0 +1,33 @@
+"""Add stored responses for requests sent with idempotency keys.
+
+Revision ID: c7e3a1f09d24
+Revises: b2f64c8e9a15
+Create Date: 2026-10-18 18:10:12.384519
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c7e3a1f09d24'
+down_revision = 'b2f64c8e9a15'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'idempotency_keys',
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id'),
+                  primary_key=True),
+        sa.Column('key', sa.String(100), primary_key=True),
+        sa.Column('fingerprint', sa.String(40), nullable=False),
+        sa.Column('status', sa.Integer, nullable=False),
+        sa.Column('response', sa.Text, nullable=False),
+        sa.Column('created_at', sa.DateTime, nullable=False))
+    op.create_index('ix_idempotency_keys_created_at', 'idempotency_keys',
+                    ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_keys_created_at', 'idempotency_keys')
+    op.drop_table('idempotency_keys')
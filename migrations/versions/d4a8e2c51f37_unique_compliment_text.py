@@ -0,0 +1,82 @@
+"""Make compliment text hashes unique per complimentee.
+
+Compliments with the same text for the same complimentee (or, for gendered
+ones, the same text) would violate the new indexes; the upgrade lists them
+and stops before changing anything.
+
+Revision ID: d4a8e2c51f37
+Revises: c7e3a1f09d24
+Create Date: 2026-10-18 19:02:47.240118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd4a8e2c51f37'
+down_revision = 'c7e3a1f09d24'
+
+import re
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+# Same as flatterer.models.GENDERED_TEXT_HASH at this revision.
+GENDERED_TEXT_HASH = ("CREATE UNIQUE INDEX ux_compliments_gendered_text_hash "
+                      "ON compliments (text_hash) WHERE user_id IS NULL")
+# Groups listed in full when the upgrade stops.
+LISTED_GROUPS = 20
+
+
+def text_hash(compliment):
+    # Same rules as flatterer.models.text_hash at this revision.
+    words = re.findall(r'\w+', (compliment or u'').lower(), re.UNICODE)
+    return hashlib.sha1(u' '.join(words).encode('utf-8')).hexdigest()
+
+
+def duplicate_groups(connection):
+    """Returns [(user_id, [(id, approved)])] for texts stored more than once.
+
+    Rows the text_hash backfill hasn't reached yet are hashed here.
+    """
+    first, groups = {}, {}
+    rows = connection.execution_options(stream_results=True).execute(
+        "SELECT id, compliment, user_id, approved, text_hash "
+        "FROM compliments ORDER BY id")
+    for id, compliment, user_id, approved, hashed in rows:
+        key = (hashed or text_hash(compliment), user_id)
+        if key not in first:
+            first[key] = (id, approved)
+        else:
+            groups.setdefault(key, [first[key]]).append((id, approved))
+    return sorted((key[1], group) for key, group in groups.items())
+
+
+def upgrade():
+    duplicates = duplicate_groups(op.get_bind())
+    if duplicates:
+        listed = ['%s: %s' % ('complimentee %d' % user_id if user_id
+                              else 'gendered',
+                              ', '.join('%d%s' % (id, '*' if approved else '')
+                                        for id, approved in group))
+                  for user_id, group in duplicates[:LISTED_GROUPS]]
+        if len(duplicates) > LISTED_GROUPS:
+            listed.append('and %d more' % (len(duplicates) - LISTED_GROUPS))
+        raise RuntimeError(
+            "Compliments stored more than once (ids, * approved): %s. Keep "
+            "one compliment of each group, then upgrade again."
+            % '; '.join(listed))
+
+    op.drop_index('ix_compliments_text_hash', 'compliments')
+    op.create_index('ux_compliments_text_hash', 'compliments',
+                    ['text_hash', 'user_id'], unique=True)
+    # MySQL has no partial indexes.
+    if op.get_bind().dialect.name in ('sqlite', 'postgresql'):
+        op.execute(GENDERED_TEXT_HASH)
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ('sqlite', 'postgresql'):
+        op.drop_index('ux_compliments_gendered_text_hash', 'compliments')
+    op.drop_index('ux_compliments_text_hash', 'compliments')
+    op.create_index('ix_compliments_text_hash', 'compliments',
+                    ['text_hash', 'user_id'])